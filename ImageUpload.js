@@ -115,7 +115,9 @@ const ImageUpload = () => {
             {recommendations.map((image, index) => (
               <Grid item xs={12} sm={6} md={4} key={index}>
                 <img
-                  src={`http://localhost:5000/${image}`}
+                  src={`http://localhost:5000/image/${image}?size=320`}
+                  srcSet={`http://localhost:5000/image/${image}?size=160 160w, http://localhost:5000/image/${image}?size=320 320w`}
+                  sizes="(min-width: 960px) 33vw, (min-width: 600px) 50vw, 100vw"
                   alt={`Recommended ${index + 1}`}
                   className={classes.recommendedImage}
                 />
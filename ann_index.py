@@ -0,0 +1,257 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+
+from similarity_search import normalize_rows, top_k_indices
+
+logger = logging.getLogger(__name__)
+
+IVF_INDEX_FILE = 'ivf.npz'
+
+
+# Assign each row of x to its nearest centroid. With spherical=True the vectors are
+# unit-length and "nearest" means largest inner product. Work is done in blocks so the
+# (rows x centroids) distance matrix never has to exist all at once.
+def assign_nearest(x, centroids, spherical=False, block_size=16384):
+    assignments = np.empty(len(x), dtype=np.int64)
+    centroid_norms = None if spherical else (centroids ** 2).sum(axis=1)
+    for start in range(0, len(x), block_size):
+        block = np.asarray(x[start:start + block_size], dtype=np.float32)
+        products = block @ centroids.T
+        if spherical:
+            assignments[start:start + len(block)] = products.argmax(axis=1)
+        else:
+            assignments[start:start + len(block)] = (centroid_norms - 2 * products).argmin(axis=1)
+    return assignments
+
+
+# Plain NumPy Lloyd's k-means, trained on a random sample of at most max_samples rows
+def kmeans(x, k, n_iter=20, spherical=False, max_samples=100000, seed=0):
+    rng = np.random.default_rng(seed)
+    if len(x) > max_samples:
+        x = x[np.sort(rng.choice(len(x), max_samples, replace=False))]
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) < k:
+        raise ValueError(f"Need at least {k} training vectors, got {len(x)}")
+
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign_nearest(x, centroids, spherical=spherical)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=k)
+        non_empty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+        centroids[non_empty] = np.add.reduceat(x[order], starts, axis=0) / counts[non_empty, None]
+
+        # Re-seed empty clusters with random training vectors
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+        if spherical:
+            centroids = normalize_rows(centroids)
+    return centroids
+
+
+# Approximate nearest-neighbour search with an inverted file (IVF).
+# A coarse spherical k-means splits the catalog into nlist cells; a query only scans the
+# nprobe cells whose centroids are closest to it. Without PQ (IVF-flat) the candidates are
+# scored against the attached catalog vectors, so a served index shares the bundle's
+# memory-mapped embeddings instead of holding a second copy. With pq_m set, the residual of every
+# vector from its cell centroid is product-quantized into pq_m one-byte codes and scored
+# with per-query lookup tables (asymmetric distance computation), shrinking the index to
+# pq_m bytes per vector. An optional exact re-rank over the original vectors recovers
+# most of the precision lost to quantization.
+class IVFIndex:
+    def __init__(self, nlist=1024, nprobe=16, pq_m=None, pq_bits=8, rerank=0):
+        if pq_bits > 8:
+            raise ValueError("pq_bits must be at most 8")
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.pq_bits = pq_bits
+        self.rerank = rerank
+        self.centroids = None
+        self.row_ids = None
+        self.offsets = None
+        self.codes = None
+        self.codebooks = None
+        self.embeddings = None
+        self.source_version = None
+
+    def __len__(self):
+        return len(self.row_ids)
+
+    @property
+    def dim(self):
+        return self.centroids.shape[1]
+
+    # Size of the index's own structures (centroids, lists, PQ codes)
+    @property
+    def nbytes(self):
+        arrays = (self.centroids, self.row_ids, self.offsets, self.codes, self.codebooks)
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    # Whether search reads the full catalog vectors: always for IVF-flat, for IVF-PQ when re-ranking
+    @property
+    def needs_embeddings(self):
+        return not self.pq_m or self.rerank > 0
+
+    # Memory needed to serve: the index structures plus the catalog vectors when search reads them
+    def serving_nbytes(self, embeddings_nbytes=None):
+        if not self.needs_embeddings:
+            return self.nbytes
+        if embeddings_nbytes is None:
+            embeddings_nbytes = self.embeddings.nbytes if self.embeddings is not None else 0
+        return self.nbytes + embeddings_nbytes
+
+    def fit(self, embeddings, n_iter=20, seed=0):
+        embeddings = normalize_rows(embeddings)
+        self.nlist = min(self.nlist, len(embeddings))
+        logger.info(f"Training coarse quantizer with {self.nlist} lists")
+        self.centroids = kmeans(embeddings, self.nlist, n_iter=n_iter, spherical=True, seed=seed)
+        assignments = assign_nearest(embeddings, self.centroids, spherical=True)
+
+        # Group rows by list so each inverted list is one contiguous slice
+        self.row_ids = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=self.nlist)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        if self.pq_m:
+            self._fit_pq(embeddings[self.row_ids] - self.centroids[assignments[self.row_ids]], n_iter=n_iter, seed=seed)
+        elif self.embeddings is None:
+            self.embeddings = embeddings
+        return self
+
+    def _fit_pq(self, residuals, n_iter=20, seed=0):
+        dim = residuals.shape[1]
+        if dim % self.pq_m:
+            raise ValueError(f"Embedding dimension {dim} is not divisible by pq_m={self.pq_m}")
+        sub_dim = dim // self.pq_m
+        ksub = min(2 ** self.pq_bits, len(residuals))
+        logger.info(f"Training product quantizer with {self.pq_m} sub-spaces of {ksub} centroids")
+
+        self.codebooks = np.empty((self.pq_m, ksub, sub_dim), dtype=np.float32)
+        self.codes = np.empty((len(residuals), self.pq_m), dtype=np.uint8)
+        for m in range(self.pq_m):
+            sub = np.ascontiguousarray(residuals[:, m * sub_dim:(m + 1) * sub_dim])
+            self.codebooks[m] = kmeans(sub, ksub, n_iter=n_iter, seed=seed + m)
+            self.codes[:, m] = assign_nearest(sub, self.codebooks[m])
+
+    # Rows in the nprobe lists closest to the query, plus each row's list number
+    def _probe(self, query):
+        lists = top_k_indices(self.centroids @ query, self.nprobe)[0]
+        spans = [np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists]
+        positions = np.concatenate(spans) if spans else np.empty(0, dtype=np.int64)
+        list_ids = np.repeat(lists, [len(s) for s in spans])
+        return positions, list_ids
+
+    def _score(self, query, positions, list_ids):
+        if not self.pq_m:
+            return np.asarray(self.embeddings[self.row_ids[positions]], dtype=np.float32) @ query
+        sub_dim = self.codebooks.shape[2]
+        lookup = np.einsum('mkd,md->mk', self.codebooks, query.reshape(self.pq_m, sub_dim))
+        residual_scores = lookup[np.arange(self.pq_m), self.codes[positions]].sum(axis=1)
+        return (self.centroids[list_ids] @ query) + residual_scores
+
+    # Returns (indices, scores) arrays of shape (num_queries, top_k); rows that could not
+    # be filled because the probed lists were too small are padded with -1 / -inf
+    def search_batch(self, queries, top_k=5):
+        if not self.pq_m and self.embeddings is None:
+            raise ValueError("An IVF-flat index needs the catalog embeddings; call attach_embeddings first")
+        queries = normalize_rows(queries)
+        indices = np.full((len(queries), top_k), -1, dtype=np.int64)
+        scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+
+        for q, query in enumerate(queries):
+            positions, list_ids = self._probe(query)
+            if len(positions) == 0:
+                continue
+            candidate_scores = self._score(query, positions, list_ids)
+            candidates = self.row_ids[positions]
+
+            if self.rerank and self.embeddings is not None and self.pq_m:
+                keep = top_k_indices(candidate_scores, max(self.rerank, top_k))[0]
+                candidates = np.sort(candidates[keep])
+                candidate_scores = np.asarray(self.embeddings[candidates], dtype=np.float32) @ query
+
+            best = top_k_indices(candidate_scores, top_k)[0]
+            indices[q, :len(best)] = candidates[best]
+            scores[q, :len(best)] = candidate_scores[best]
+        return indices, scores
+
+    def search(self, query, top_k=5):
+        indices, scores = self.search_batch(query, top_k)
+        return indices[0], scores[0]
+
+    # Keep a reference to the original (normalized) catalog vectors, which IVF-flat scores
+    # against and IVF-PQ re-ranks with
+    def attach_embeddings(self, embeddings):
+        self.embeddings = embeddings
+        return self
+
+    # source_version records which index bundle the lists were trained on
+    def save(self, path, source_version=None):
+        self.source_version = source_version
+        arrays = {
+            'params': np.array([self.nlist, self.nprobe, self.pq_m or 0, self.pq_bits, self.rerank]),
+            'source_version': np.array(source_version or ''),
+            'centroids': self.centroids,
+            'row_ids': self.row_ids,
+            'offsets': self.offsets,
+        }
+        if self.pq_m:
+            arrays['codes'] = self.codes
+            arrays['codebooks'] = self.codebooks
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            nlist, nprobe, pq_m, pq_bits, rerank = (int(v) for v in data['params'])
+            index = cls(nlist=nlist, nprobe=nprobe, pq_m=pq_m or None, pq_bits=pq_bits, rerank=rerank)
+            index.centroids = data['centroids']
+            index.row_ids = data['row_ids']
+            index.offsets = data['offsets']
+            index.source_version = str(data['source_version']) or None
+            # Older IVF-flat files also hold a 'vectors' copy of the catalog, which is no longer read
+            if pq_m:
+                index.codes = data['codes']
+                index.codebooks = data['codebooks']
+        return index
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Train an IVF / IVF-PQ index for an index bundle')
+    parser.add_argument("--bundle", type=str, default="index_bundle")
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--pq_m", type=int, default=0, help="Number of PQ sub-spaces; 0 scores the full vectors")
+    parser.add_argument("--pq_bits", type=int, default=8)
+    parser.add_argument("--rerank", type=int, default=0, help="Exact re-rank depth for PQ indexes")
+    parser.add_argument("--iterations", type=int, default=20)
+    return parser.parse_args()
+
+
+def main():
+    from index_bundle import load_index_bundle
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    bundle = load_index_bundle(args.bundle)
+
+    started_at = time.time()
+    index = IVFIndex(nlist=args.nlist, nprobe=args.nprobe, pq_m=args.pq_m or None,
+                     pq_bits=args.pq_bits, rerank=args.rerank)
+    index.fit(bundle.embeddings, n_iter=args.iterations)
+    index.save(os.path.join(args.bundle, IVF_INDEX_FILE), source_version=bundle.version)
+    logger.info(f"Trained IVF index in {time.time() - started_at:.1f}s ({index.nbytes / 2**20:.1f} MiB index, "
+                f"{index.serving_nbytes(bundle.embeddings.nbytes) / 2**20:.1f} MiB to serve)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,30 @@
-from flask import Flask, request, jsonify, send_from_directory
+import time
+# Startup timings are measured from here; see /ready and the fashion_startup_seconds metric
+startup_started_at = time.perf_counter()
+
+from flask import Flask, request, jsonify, send_file, send_from_directory, g, Response, has_request_context
 from flask_cors import CORS
 import os
+import io
+import mimetypes
+import threading
+import zipfile
 import numpy as np
-import tensorflow as tf
 import logging
-from sklearn.metrics.pairwise import cosine_similarity
-import cv2
-import glob
-import joblib
+from similarity_search import search_rows
+from index_bundle import model_fingerprint
+from tflite_embedder import read_source_fingerprint
+from catalog_segments import load_catalog_generation, CatalogReloader
+from request_batcher import MicroBatcher, QueueFullError
+from image_preprocessing import decode_image, resize_image, preprocess_batch
+from attribute_index import UnknownFilterError, FILTER_ATTRIBUTES
+from query_cache import QueryCache, bytes_key, pixels_key
+from concurrent.futures import Future
+from service_metrics import MetricsRegistry, Counter, Gauge, Histogram, RequestTrace
+from thumbnails import THUMBNAIL_SIZES, ensure_thumbnail, etag_sidecar_path, file_etag
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.utils import safe_join
+import_seconds = time.perf_counter() - startup_started_at
 
 app = Flask(__name__)
 CORS(app)
@@ -21,50 +38,430 @@ current_directory = os.path.dirname(os.path.abspath(__file__))
 model_file_path = os.path.join(current_directory, 'model_80x80.pkl')  # Update with your .pkl file
 logger.info(f"Model Path: {model_file_path}")
 
-# Load the pre-trained model using joblib
-loaded_model = joblib.load(model_file_path)
+# Model runtime: 'keras' unpickles the full Keras model; 'tflite' runs the compact artifact
+# produced by export_tflite.py (e.g. model_80x80_int8.tflite) instead
+model_runtime = os.environ.get('FASHION_MODEL_RUNTIME', 'keras')
+if model_runtime == 'tflite':
+    tflite_model_path = os.environ.get('FASHION_TFLITE_MODEL', os.path.join(current_directory, 'model_80x80_float16.tflite'))
+    logger.info(f"TFLite model path: {tflite_model_path}")
+
+# With FASHION_LAZY_START=1 the model is loaded and warmed up in a background thread, so the
+# process answers /health at once and /ready (and /recommend) only once the model is warm.
+# Otherwise the import blocks until the server is fully warm.
+lazy_start = os.environ.get('FASHION_LAZY_START', '0') == '1'
+warmup_batch_size = int(os.environ.get('FASHION_WARMUP_BATCH', '8'))
+loaded_model = None
+model_ready = threading.Event()
+startup_timings = {'import_s': import_seconds}
+
+# The index bundle (see index_bundle.py) holds the normalized catalog embeddings and the
+# row -> image filename manifest. The embeddings are memory-mapped, not read eagerly.
+# Items added or retired since the bundle was built live in its delta segment (see
+# catalog_segments.py) and are searched alongside it.
+index_bundle_path = os.environ.get('FASHION_INDEX_DIR', os.path.join(current_directory, 'index_bundle'))
+
+# Search backend: 'exact' (default) or 'ivf' for the approximate index built by ann_index.py
+search_backend = os.environ.get('FASHION_SEARCH_BACKEND', 'exact')
+search_nprobe = int(os.environ.get('FASHION_SEARCH_NPROBE', '0')) or None
+
+# Seconds between checks for catalog updates; 0 disables hot reload
+reload_interval = float(os.environ.get('FASHION_RELOAD_INTERVAL', '30'))
+
+# The index is matched against the Keras model it was built with: the .pkl itself when it is
+# deployed, otherwise the source fingerprint export_tflite.py recorded next to the .tflite file
+# (None skips the check). Cached results are also keyed by the artifact actually serving,
+# since quantized runtimes give slightly different embeddings.
+if model_runtime == 'keras' or os.path.exists(model_file_path):
+    served_model_fingerprint = model_fingerprint(model_file_path)
+else:
+    served_model_fingerprint = read_source_fingerprint(tflite_model_path)
+runtime_fingerprint = model_fingerprint(tflite_model_path) if model_runtime == 'tflite' else served_model_fingerprint
+
+
+def load_catalog():
+    generation = load_catalog_generation(index_bundle_path, backend=search_backend, nprobe=search_nprobe)
+    logger.info(f"Catalog {generation.version}: {len(generation)} vectors of dimension {generation.search_index.dim}")
+    if generation.attribute_index is None:
+        logger.warning("No attribute index for this catalog; attribute filters are disabled")
+    if served_model_fingerprint and generation.bundle.model_fingerprint and \
+            generation.bundle.model_fingerprint != served_model_fingerprint:
+        logger.warning("Index bundle was built with a different model than the one being served")
+    return generation
+
+
+# The current catalog generation. Requests read it once and use that snapshot throughout, so
+# swapping in a new generation never disturbs requests already in flight.
+catalog_load_started_at = time.perf_counter()
+catalog = load_catalog()
+startup_timings['catalog_load_s'] = time.perf_counter() - catalog_load_started_at
+
+target_size = tuple(catalog.bundle.preprocessing['target_size'])
+
+# Concurrent /recommend calls are grouped into one forward pass and one batched search
+batch_max_size = int(os.environ.get('FASHION_BATCH_MAX_SIZE', '32'))
+batch_max_wait_ms = float(os.environ.get('FASHION_BATCH_WAIT_MS', '5'))
+# Queries waiting for inference beyond this are rejected with 503 (0 = unbounded)
+batch_max_queue = int(os.environ.get('FASHION_MAX_QUEUE', '256'))
+top_n = 5
 
-# Assuming the feature vectors file is in the same directory as the script
-feature_vectors_file = os.path.join(current_directory, 'raw_features_MainDataset_80x80.npy')
+# Request bodies above this are rejected with 413 before they are read (uploads and archives
+# are held in memory while a request is processed)
+max_request_bytes = int(os.environ.get('FASHION_MAX_REQUEST_BYTES', str(64 * 1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = max_request_bytes
 
-# Load the pre-computed image feature vectors
-normalized_features = np.load(feature_vectors_file)
-logger.info(f"Normalized features: {normalized_features}")
+# Limits for /recommend/batch
+batch_max_images = int(os.environ.get('FASHION_BATCH_MAX_IMAGES', '64'))
+zip_member_max_bytes = 20 * 1024 * 1024
+image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
 
-target_size = (80, 80)
+# Catalog images for /image/<path>: originals, or ?size=80|160|320 thumbnails generated on first
+# request (or in bulk with thumbnails.py) and cached on disk
+image_directory = os.path.join(current_directory, 'images')
+thumbnail_directory = os.environ.get('FASHION_THUMBNAIL_DIR', os.path.join(current_directory, 'thumbnails'))
+image_max_age = int(os.environ.get('FASHION_IMAGE_MAX_AGE', '86400'))
 
-def extract_image_features(image_path):
+# Per-request timing spans are aggregated into histograms served on /metrics; full traces
+# are logged for a sampled fraction of requests only
+trace_sample_rate = float(os.environ.get('FASHION_TRACE_SAMPLE_RATE', '0.01'))
+metrics = MetricsRegistry()
+stage_seconds = metrics.register(Histogram('fashion_stage_seconds', 'Time spent per request stage', ('stage',)))
+request_seconds = metrics.register(Histogram('fashion_request_seconds', 'Request latency', ('endpoint',)))
+requests_total = metrics.register(Counter('fashion_requests_total', 'Requests served', ('endpoint', 'status')))
+batch_size_histogram = metrics.register(Histogram('fashion_inference_batch_size', 'Queries per inference batch',
+                                                  buckets=(1, 2, 4, 8, 16, 32, 64, 128)))
+in_flight_requests = metrics.register(Gauge('fashion_in_flight_requests', 'Requests currently being served'))
+
+
+def new_trace():
+    name = request.endpoint if has_request_context() else None
+    return RequestTrace(stage_seconds, sample_rate=trace_sample_rate, name=name or 'request')
+
+
+def current_trace():
+    return g.get('trace') or new_trace()
+
+
+# Uploads are decoded straight from the request bytes; nothing is written to disk
+def load_query_image(image_bytes, trace=None):
+    trace = trace or new_trace()
     try:
-        img = cv2.imread(image_path)
-        img = cv2.resize(img, target_size)
-        x = tf.keras.applications.mobilenet.preprocess_input(img[np.newaxis, ...])
-        features = loaded_model.predict(x)
-        return features
+        with trace.span('decode'):
+            img = decode_image(image_bytes)
+        if img is None:
+            logger.error("Uploaded file is not a decodable image")
+            return None
+        with trace.span('resize'):
+            return resize_image(img, target_size)
     except Exception as e:
         logger.error(f"Error processing the uploaded image: {e}")
         return None
 
 
-def get_similar_images(image_index, cosine_similarities, top_n=5):
-    similarity_scores = list(enumerate(cosine_similarities[image_index]))
-    similarity_scores = sorted(similarity_scores, key=lambda x: x[1], reverse=True)
-    top_similar_images = similarity_scores[1:top_n+1]
-    similar_image_indices = [index for index, _ in top_similar_images]
-    return similar_image_indices
+# (name, bytes) for every image in the batch request: files sent as 'images' (or 'image')
+# fields, and the image members of any uploaded .zip archive
+def read_batch_uploads(files):
+    uploads = []
+    for uploaded_file in files.getlist('images') + files.getlist('image') + files.getlist('archive'):
+        data = uploaded_file.read()
+        if zipfile.is_zipfile(io.BytesIO(data)):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for member in archive.infolist():
+                    # Stop early; the caller rejects requests over the limit
+                    if len(uploads) > batch_max_images:
+                        break
+                    if member.is_dir() or not member.filename.lower().endswith(image_extensions):
+                        continue
+                    if member.file_size > zip_member_max_bytes:
+                        uploads.append((member.filename, None))
+                        continue
+                    uploads.append((member.filename, archive.read(member)))
+        else:
+            uploads.append((uploaded_file.filename, data))
+    return uploads
+
+
+# Same transform as tf.keras.applications.mobilenet.preprocess_input, without importing TensorFlow
+def preprocess_images(images):
+    return preprocess_batch(np.stack(images))
+
+
+# Run the model on a list of resized images in a single predict call, and map the outputs into
+# the catalog's search space (a no-op unless the bundle was reduced by embedding_projection.py)
+def extract_image_features(images, generation=None):
+    return (generation or catalog).project(loaded_model.predict(preprocess_images(images)))
+
+
+# Each query is (image, filter_rows, catalog generation, trace) and gets back
+# (embedding, filenames). Unfiltered queries of a generation share one batched search; filtered
+# queries only score the catalog rows that match their filter. Batch-level stage timings are
+# added to the trace of every request in the batch.
+def _recommend_batch(queries):
+    timings = {'preprocess': 0.0, 'model_predict': 0.0, 'search': 0.0, 'filename_mapping': 0.0}
+    batch_size_histogram.observe(len(queries))
+
+    started_at = time.perf_counter()
+    x = preprocess_images([img for img, _, _, _ in queries])
+    timings['preprocess'] = time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    features = loaded_model.predict(x)
+    timings['model_predict'] = time.perf_counter() - started_at
+
+    indices = [None] * len(queries)
+    started_at = time.perf_counter()
+    for generation in {id(q[2]): q[2] for q in queries}.values():
+        unfiltered = [i for i, (_, rows, gen, _) in enumerate(queries) if gen is generation and rows is None]
+        if unfiltered:
+            similar_image_indices, _ = generation.search_index.search_batch(generation.project(features[unfiltered]),
+                                                                            top_k=top_n)
+            for i, row in zip(unfiltered, similar_image_indices):
+                indices[i] = row
+    for i, (_, rows, generation, _) in enumerate(queries):
+        if rows is not None:
+            indices[i], _ = search_rows(generation.search_index, generation.project(features[i:i + 1])[0], rows,
+                                        top_k=top_n)
+    timings['search'] = time.perf_counter() - started_at
+
+    # Approximate backends pad with -1 when the probed lists hold fewer than top_n items
+    started_at = time.perf_counter()
+    results = [(features[i], [generation.filenames[idx] for idx in indices[i] if idx >= 0])
+               for i, (_, _, generation, _) in enumerate(queries)]
+    timings['filename_mapping'] = time.perf_counter() - started_at
+
+    for _, _, _, trace in queries:
+        for stage, seconds in timings.items():
+            trace.add_span(stage, seconds)
+    return results
+
+
+inference_batcher = MicroBatcher(_recommend_batch, max_batch_size=batch_max_size, max_wait_ms=batch_max_wait_ms,
+                                 max_queue_size=batch_max_queue)
+
+
+def cache_version(generation):
+    return f"{generation.version}:{runtime_fingerprint[:16]}"
+
+
+# Repeated uploads of the same photo are answered from a cache of (embedding, top-k) results.
+# Entries are scoped to the catalog generation and model fingerprint.
+query_cache = QueryCache(max_entries=int(os.environ.get('FASHION_CACHE_SIZE', '10000')),
+                         ttl_seconds=float(os.environ.get('FASHION_CACHE_TTL', '3600')),
+                         version=cache_version(catalog))
+cache_pixel_keys = os.environ.get('FASHION_CACHE_PIXEL_KEYS', '0') == '1'
+
+
+def swap_catalog(generation):
+    global catalog
+    catalog = generation
+    query_cache.set_version(cache_version(generation))
+
+
+if reload_interval > 0:
+    catalog_reloader = CatalogReloader(index_bundle_path, load_catalog, swap_catalog, interval=reload_interval).start()
+
+
+# TensorFlow (or tflite_runtime) and joblib are only imported here
+def load_embedding_model():
+    if model_runtime == 'tflite':
+        from tflite_embedder import TFLiteEmbedder
+        return TFLiteEmbedder(tflite_model_path, num_threads=int(os.environ.get('FASHION_TFLITE_THREADS', '0')) or None,
+                              max_batch_size=max(batch_max_size, warmup_batch_size))
+    from keras_embedder import KerasEmbedder
+    return KerasEmbedder(model_file_path)
+
+
+# Load the model and push one warm-up batch through preprocessing, the traced predict function
+# and the catalog search, so the first real request pays neither for tracing nor for faulting
+# in the memory-mapped index. The server reports ready only after this.
+def warm_up():
+    global loaded_model
+    try:
+        started_at = time.perf_counter()
+        model = load_embedding_model()
+        startup_timings['model_load_s'] = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        images = [np.zeros((target_size[1], target_size[0], 3), dtype=np.uint8)] * warmup_batch_size
+        features = model.predict(preprocess_images(images))
+        catalog.search_index.search_batch(catalog.project(features), top_k=top_n)
+        startup_timings['first_inference_s'] = time.perf_counter() - started_at
+
+        loaded_model = model
+        startup_timings['ready_s'] = time.perf_counter() - startup_started_at
+        model_ready.set()
+        logger.info('Ready; startup timings: ' + ', '.join(f'{k}={v:.3f}' for k, v in startup_timings.items()))
+    except Exception:
+        logger.exception('Model load or warm-up failed; the server will not report ready')
+        if not lazy_start:
+            raise
+
+
+if lazy_start:
+    threading.Thread(target=warm_up, name='model-warmup', daemon=True).start()
+else:
+    warm_up()
+
+
+def _completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+# Attribute filters come from a free-form 'filters' field ("Women, Footwear, season=Summer")
+# and/or one form field per attribute. Returns (matching rows, cache key suffix), or
+# (None, '') when no filter was given.
+def parse_request_filters(form, generation):
+    text = ','.join([form.get('filters', '')] +
+                    [f'{attribute}={value}' for attribute in FILTER_ATTRIBUTES
+                     for value in form.get(attribute, '').split(',') if value.strip()])
+    if not text.strip(','):
+        return None, ''
+    if generation.attribute_index is None:
+        raise UnknownFilterError('Attribute filters are not available for this index')
+    filters = generation.attribute_index.parse_filters(text)
+    filter_key = ';'.join(f"{attribute}={'|'.join(sorted(values))}" for attribute, values in sorted(filters.items()))
+    return generation.attribute_index.matching_rows(filters), filter_key
+
+
+# Returns a Future for the (embedding, recommended filenames) of an upload, or None if the
+# bytes cannot be decoded. Cache hits return an already completed Future.
+def submit_query(image_bytes, generation, filter_rows=None, filter_key='', trace=None):
+    trace = trace or new_trace()
+    keys = [bytes_key(image_bytes) + filter_key]
+    cached = query_cache.get(keys[0])
+    if cached is not None:
+        return _completed(cached)
+
+    img = load_query_image(image_bytes, trace)
+    if img is None:
+        return None
+
+    if cache_pixel_keys:
+        keys.append(pixels_key(img) + filter_key)
+        cached = query_cache.get(keys[1])
+        if cached is not None:
+            query_cache.put(keys[:1], cached)
+            return _completed(cached)
+
+    version = cache_version(generation)
+
+    def store_result(future):
+        if future.exception() is None:
+            query_cache.put(keys, future.result(), version=version)
+
+    future = inference_batcher.submit_async((img, filter_rows, generation, trace))
+    future.add_done_callback(store_result)
+    return future
+
+def overloaded_response():
+    logger.warning('Inference queue is full; rejecting request')
+    response = jsonify({'error': 'The server is overloaded. Please try again shortly.'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@app.before_request
+def start_request_trace():
+    g.started_at = time.perf_counter()
+    g.trace = new_trace()
+    in_flight_requests.inc()
+
+
+def request_too_large_response():
+    return jsonify({'error': f'Request body too large; the limit is {max_request_bytes} bytes'}), 413
+
+
+# A declared Content-Length over the limit is refused up front; a body that turns out larger
+# while streaming makes werkzeug raise RequestEntityTooLarge, answered the same way
+@app.before_request
+def reject_large_requests():
+    if request.content_length is not None and request.content_length > max_request_bytes:
+        return request_too_large_response()
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    return request_too_large_response()
+
+
+# Until the model is warm, recommendation requests are turned away rather than queued
+@app.before_request
+def reject_until_ready():
+    if request.endpoint in ('recommend', 'recommend_batch') and not model_ready.is_set():
+        response = jsonify({'error': 'The server is starting. Please try again shortly.'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+
+@app.after_request
+def record_request_metrics(response):
+    if 'started_at' in g:
+        request_seconds.observe(time.perf_counter() - g.started_at, request.endpoint or 'unknown')
+        requests_total.inc(request.endpoint or 'unknown', response.status_code)
+    return response
+
+
+@app.teardown_request
+def finish_request_trace(exception=None):
+    if 'trace' in g:
+        in_flight_requests.dec()
+        g.trace.finish(total_ms=round((time.perf_counter() - g.started_at) * 1000, 3), **g.get('trace_fields', {}))
+
 
 @app.route('/')
 def index():
     return "Welcome to the Fashion Recommendation API!"
 
+# Liveness: the process is up and serving HTTP
+@app.route('/health')
+def health():
+    return jsonify({'status': 'ok'}), 200
+
+# Readiness: the model is loaded and warmed up
+@app.route('/ready')
+def ready():
+    if not model_ready.is_set():
+        return jsonify({'status': 'starting', 'startup_timings': startup_timings}), 503
+    return jsonify({'status': 'ready', 'startup_timings': startup_timings}), 200
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
+# Images are served with a strong (content hash) ETag and Cache-Control; a request whose
+# If-None-Match still matches gets an empty 304. The hash comes from the ETag sidecar written
+# with each thumbnail (and for originals by thumbnails.py), so only an original that was never
+# pre-processed is hashed, once, on a request.
 @app.route('/image/<path:image_filename>')
 def serve_image(image_filename):
     try:
-        return send_from_directory(os.path.join(current_directory, 'images'), image_filename)
+        source_path = safe_join(image_directory, image_filename)
+        if source_path is None or not os.path.isfile(source_path):
+            return jsonify({'error': 'Image not found'}), 404
+
+        size = request.args.get('size')
+        if size is None:
+            path = source_path
+        elif size.isdigit() and int(size) in THUMBNAIL_SIZES:
+            path = ensure_thumbnail(image_directory, thumbnail_directory, image_filename, int(size))
+            if path is None:
+                return jsonify({'error': 'Image not found'}), 404
+        else:
+            return jsonify({'error': f'Unsupported size; choose one of {list(THUMBNAIL_SIZES)}'}), 400
+
+        etag = file_etag(path, etag_sidecar_path(thumbnail_directory, image_filename, int(size) if size else None))
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            # Thumbnails are always JPEG; originals keep their own type
+            mimetype = 'image/jpeg' if size else mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            # Streamed from disk with Range support; the content-hash ETag replaces werkzeug's own
+            response = send_file(path, mimetype=mimetype, etag=False, conditional=True)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = f'public, max-age={image_max_age}'
+        return response
     except Exception as e:
+        logger.exception('Error serving image')
         return jsonify({'error': 'Image not found'}), 404
 
 @app.route('/recommend', methods=['POST'])
@@ -73,46 +470,97 @@ def recommend():
         if 'image' not in request.files:
             return jsonify({'error': 'No image uploaded'}), 400
 
-        uploaded_image = request.files['image']
-        temp_image_path = 'temp.jpg'
-        uploaded_image.save(temp_image_path)
+        generation = catalog
+        try:
+            filter_rows, filter_key = parse_request_filters(request.form, generation)
+        except UnknownFilterError as e:
+            return jsonify({'error': str(e)}), 400
 
-        uploaded_features = extract_image_features(temp_image_path)
+        trace = current_trace()
+        with trace.span('upload_read'):
+            image_bytes = request.files['image'].read()
 
-        if uploaded_features is None:
+        # Embed the uploaded image and score it against the catalog, batched with concurrent requests
+        query = submit_query(image_bytes, generation, filter_rows, filter_key, trace)
+
+        if query is None:
             return jsonify({'error': 'Error processing the uploaded image. Please try again.'}), 500
 
-        # Append the new image features to the existing normalized features
-        updated_features = np.vstack((normalized_features, uploaded_features))
-        logger.info(f"updated_features: {updated_features}")
+        # Filenames with extensions of the recommended images, mapped through the index manifest
+        _, image_filenames = query.result()
+        g.trace_fields = {'recommended_images': image_filenames}
 
-        # Normalize the entire feature array
-        # data_normalized = updated_features / np.linalg.norm(updated_features, axis=1, keepdims=True)
-        # logger.info(f"data_normalized: {data_normalized}")
+        return jsonify({'recommended_images': image_filenames}), 200
+
+    except QueueFullError:
+        return overloaded_response()
+    except RequestEntityTooLarge:
+        return request_too_large_response()
+    except Exception as e:
+        logger.exception('Error occurred during recommendation')
+        return jsonify({'error': 'An error occurred during recommendation. Please try again later.'}), 500
 
-        # Compute cosine similarity with the input image
-        # logger.info("Before computing cosine similarities.")
-        # cosine_similarities = np.dot(data_normalized, data_normalized.T)
-        cosine_similarities = cosine_similarity(updated_features)
-        logger.info("After computing cosine similarities: %s", cosine_similarities[-1])
 
-        image_index = -1  # Index of the uploaded image
-        similar_image_indices = get_similar_images(image_index, cosine_similarities)
+@app.route('/recommend/batch', methods=['POST'])
+def recommend_batch():
+    try:
+        trace = current_trace()
+        with trace.span('upload_read'):
+            uploads = read_batch_uploads(request.files)
+        if not uploads:
+            return jsonify({'error': 'No images uploaded'}), 400
+        if len(uploads) > batch_max_images:
+            return jsonify({'error': f'Too many images; the limit is {batch_max_images} per request'}), 413
 
-        # Get the file paths of recommended images
-        image_dir = 'images'
-        image_paths = glob.glob(os.path.join(current_directory, image_dir, '*.jpg'))
+        # Submit every decodable image at once so they share batched forward passes
+        generation = catalog
+        try:
+            filter_rows, filter_key = parse_request_filters(request.form, generation)
+        except UnknownFilterError as e:
+            return jsonify({'error': str(e)}), 400
 
-        # Get the filenames with extensions of recommended images
-        image_filenames = [os.path.basename(image_paths[idx]) for idx in similar_image_indices]
-        logger.info(f"Recommended Image Filenames: {image_filenames}")
+        pending = [(name, submit_query(data, generation, filter_rows, filter_key, trace) if data is not None else None)
+                   for name, data in uploads]
 
-        return jsonify({'recommended_images': image_filenames}), 200
+        results = []
+        for name, future in pending:
+            if future is None:
+                results.append({'filename': name, 'error': 'Error processing the uploaded image.'})
+                continue
+            _, image_filenames = future.result()
+            results.append({'filename': name, 'recommended_images': image_filenames})
+
+        return jsonify({'results': results}), 200
 
+    except QueueFullError:
+        return overloaded_response()
+    except RequestEntityTooLarge:
+        return request_too_large_response()
     except Exception as e:
-        logger.exception('Error occurred during recommendation')
+        logger.exception('Error occurred during batch recommendation')
         return jsonify({'error': 'An error occurred during recommendation. Please try again later.'}), 500
 
+@app.route('/stats/cache')
+def cache_stats():
+    return jsonify(query_cache.stats()), 200
+
+
+metrics.register(Gauge('fashion_index_size', 'Vectors in the current catalog generation', callback=lambda: len(catalog)))
+metrics.register(Gauge('fashion_model_info', 'Serving model and catalog versions',
+                       ('runtime', 'model_fingerprint', 'catalog_version'),
+                       callback=lambda: {(model_runtime, runtime_fingerprint[:16], catalog.version): 1}))
+metrics.register(Gauge('fashion_inference_queue_depth', 'Queries waiting for an inference batch',
+                       callback=lambda: inference_batcher.pending()))
+metrics.register(Gauge('fashion_startup_seconds', 'Import, model load, first inference and total time to ready',
+                       ('phase',), callback=lambda: {(k[:-2],): v for k, v in startup_timings.items()}))
+metrics.register(Gauge('fashion_query_cache', 'Query cache counters', ('counter',),
+                       callback=lambda: {(k,): v for k, v in query_cache.stats().items() if k != 'version'}))
+
+
+# Prometheus scrape endpoint. Under serve.py each worker process reports its own metrics.
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,163 @@
+import argparse
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ATTRIBUTES_FILE = 'attributes.npz'
+FILTER_ATTRIBUTES = ['gender', 'masterCategory', 'subCategory', 'articleType', 'baseColour', 'season', 'usage']
+
+
+class UnknownFilterError(ValueError):
+    pass
+
+
+# Posting lists over the index bundle rows: for every (attribute, value) pair from styles.csv,
+# the sorted array of row numbers whose item has that value. Values are matched
+# case-insensitively. A filter is resolved to the intersection of its posting lists (the union
+# when several values are given for one attribute), so a filtered query only scores those rows.
+class AttributeIndex:
+    def __init__(self, postings, num_rows, source_version=None):
+        self.postings = postings
+        self.num_rows = num_rows
+        self.source_version = source_version
+        self._values = {}
+        for attribute, value in postings:
+            self._values.setdefault(value, []).append(attribute)
+
+    @classmethod
+    def build(cls, styles, ids, source_version=None):
+        row_of_id = {str(image_id): row for row, image_id in enumerate(ids)}
+        styles = styles.assign(row=styles['id'].astype(str).map(row_of_id)).dropna(subset=['row'])
+        postings = {}
+        for attribute in FILTER_ATTRIBUTES:
+            column = styles[attribute].dropna().astype(str).str.strip().str.lower()
+            for value, rows in styles.loc[column.index, 'row'].groupby(column):
+                postings[(attribute, value)] = np.sort(rows.to_numpy(dtype=np.int64))
+        return cls(postings, len(ids), source_version)
+
+    # The index for a rearranged catalog: new_rows[old_row] is the old row's new number, or -1
+    # when the row is gone
+    def remap(self, new_rows, num_rows, source_version=None):
+        postings = {}
+        for key, rows in self.postings.items():
+            rows = new_rows[rows]
+            rows = np.sort(rows[rows >= 0])
+            if len(rows):
+                postings[key] = rows
+        return AttributeIndex(postings, num_rows, source_version)
+
+    # The index with rows num_rows, num_rows + 1, ... appended, one {attribute: value} dict
+    # (see item_attributes) per new row
+    def extend(self, attributes):
+        added = {}
+        for offset, item in enumerate(attributes):
+            for attribute, value in item.items():
+                added.setdefault((attribute, value), []).append(self.num_rows + offset)
+        postings = dict(self.postings)
+        for key, rows in added.items():
+            postings[key] = np.concatenate([postings.get(key, np.empty(0, dtype=np.int64)),
+                                            np.array(rows, dtype=np.int64)])
+        return AttributeIndex(postings, self.num_rows + len(attributes), self.source_version)
+
+    def save(self, path):
+        arrays = {f'{attribute}={value}': rows for (attribute, value), rows in self.postings.items()}
+        # Written under a temporary name and renamed, so a reloading server never reads half a file
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, __num_rows__=np.array(self.num_rows),
+                 __source_version__=np.array(self.source_version or ''), **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            num_rows = int(data['__num_rows__'])
+            source_version = str(data['__source_version__']) or None
+            postings = {tuple(key.split('=', 1)): data[key] for key in data.files if not key.startswith('__')}
+        return cls(postings, num_rows, source_version)
+
+    def values(self, attribute):
+        return sorted(value for attr, value in self.postings if attr == attribute)
+
+    # Parse "Women, Footwear, season=Summer" into {attribute: {values}}. Bare values are
+    # looked up across all attributes; unknown attributes or values raise UnknownFilterError,
+    # whether the value is bare or written as attribute=value.
+    def parse_filters(self, text):
+        filters = {}
+        for token in (t.strip() for t in text.split(',')):
+            if not token:
+                continue
+            if '=' in token:
+                attribute, value = (part.strip() for part in token.split('=', 1))
+                if attribute not in FILTER_ATTRIBUTES:
+                    raise UnknownFilterError(f"Unknown filter attribute: {attribute}")
+                if (attribute, value.lower()) not in self.postings:
+                    raise UnknownFilterError(f"Unknown filter value: {attribute}={value}")
+                filters.setdefault(attribute, set()).add(value.lower())
+                continue
+            attributes = self._values.get(token.lower())
+            if not attributes:
+                raise UnknownFilterError(f"Unknown filter value: {token}")
+            # A bare value that exists under several attributes uses the first (most general) one
+            attribute = min(attributes, key=FILTER_ATTRIBUTES.index)
+            filters.setdefault(attribute, set()).add(token.lower())
+        return filters
+
+    # Sorted row numbers matching every attribute in filters, or None for "no filter"
+    def matching_rows(self, filters):
+        rows = None
+        for attribute, values in filters.items():
+            lists = [self.postings.get((attribute, value)) for value in values]
+            lists = [l for l in lists if l is not None]
+            matched = np.unique(np.concatenate(lists)) if lists else np.empty(0, dtype=np.int64)
+            rows = matched if rows is None else np.intersect1d(rows, matched, assume_unique=True)
+        return rows
+
+
+# {attribute: normalized value} for one item, from a styles.csv row or any mapping; missing
+# values are left out
+def item_attributes(values):
+    item = {}
+    for attribute in FILTER_ATTRIBUTES:
+        value = values.get(attribute)
+        if value is None or value != value:
+            continue
+        value = str(value).strip().lower()
+        if value:
+            item[attribute] = value
+    return item
+
+
+# item_attributes for each id, {} for ids not in styles.csv
+def attributes_for_ids(styles, ids):
+    rows = {str(row['id']): row for row in styles.to_dict('records')}
+    return [item_attributes(rows.get(str(image_id), {})) for image_id in ids]
+
+
+def load_styles(csv_file_path):
+    import pandas as pd
+    return pd.read_csv(csv_file_path, usecols=['id'] + FILTER_ATTRIBUTES, on_bad_lines='skip')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build attribute posting lists for an index bundle')
+    parser.add_argument("--bundle", type=str, default="index_bundle")
+    parser.add_argument("--styles", type=str, default="styles.csv")
+    return parser.parse_args()
+
+
+def main():
+    from index_bundle import load_index_bundle
+
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    bundle = load_index_bundle(args.bundle)
+    attribute_index = AttributeIndex.build(load_styles(args.styles), bundle.ids, source_version=bundle.version)
+    attribute_index.save(os.path.join(args.bundle, ATTRIBUTES_FILE))
+    logger.info(f"Saved {len(attribute_index.postings)} posting lists for {len(bundle)} rows")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+
+from ann_index import IVFIndex
+from similarity_search import ExactSearchIndex, normalize_rows
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare IVF / IVF-PQ search against exact search')
+    parser.add_argument("--bundle", type=str, default=None, help="Index bundle to benchmark on")
+    parser.add_argument("--synthetic", type=int, default=50000, help="Synthetic catalog size when no bundle is given")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--nlist", type=int, default=1024)
+    parser.add_argument("--nprobe", type=str, default="1,4,8,16,32,64")
+    parser.add_argument("--pq_m", type=str, default="0,32,64", help="Comma separated; 0 means no PQ")
+    parser.add_argument("--rerank", type=int, default=100)
+    parser.add_argument("--iterations", type=int, default=15)
+    parser.add_argument("--output", type=str, default=None, help="Write results to this JSON file")
+    return parser.parse_args()
+
+
+# Clustered random vectors, so the benchmark has neighbourhood structure like real embeddings
+def synthetic_catalog(size, dim, n_clusters=256, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, n_clusters, size)
+    return centers[labels] + 0.5 * rng.standard_normal((size, dim)).astype(np.float32)
+
+
+def recall_at(found, truth, k):
+    hits = [len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth)]
+    return float(np.mean(hits)) / k
+
+
+# Search one query at a time, like the server does, and return indices and per-query latencies
+def timed_search(index, queries, top_k):
+    indices = np.empty((len(queries), top_k), dtype=np.int64)
+    latencies = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        started_at = time.perf_counter()
+        indices[i] = index.search(query, top_k)[0]
+        latencies[i] = time.perf_counter() - started_at
+    return indices, latencies
+
+
+# index_mib counts the index structures alone; serving_mib adds the catalog vectors when
+# search reads them (exact search, IVF-flat, IVF-PQ with re-ranking)
+def summarize(name, indices, latencies, truth, nbytes, serving_nbytes, **params):
+    return dict(
+        backend=name,
+        **params,
+        recall_at_5=recall_at(indices, truth, 5),
+        recall_at_10=recall_at(indices, truth, 10),
+        latency_ms_mean=float(latencies.mean() * 1000),
+        latency_ms_p95=float(np.percentile(latencies, 95) * 1000),
+        index_mib=nbytes / 2**20,
+        serving_mib=serving_nbytes / 2**20,
+    )
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    if args.bundle:
+        from index_bundle import load_index_bundle
+        embeddings = np.asarray(load_index_bundle(args.bundle).embeddings, dtype=np.float32)
+    else:
+        embeddings = synthetic_catalog(args.synthetic, args.dim)
+    embeddings = normalize_rows(embeddings)
+
+    # Hold out the queries so they are not trivially their own nearest neighbour
+    rng = np.random.default_rng(1)
+    held_out = rng.choice(len(embeddings), args.queries, replace=False)
+    queries = embeddings[held_out]
+    catalog = np.delete(embeddings, held_out, axis=0)
+    top_k = 10
+
+    exact = ExactSearchIndex(catalog, normalized=True)
+    truth, latencies = timed_search(exact, queries, top_k)
+    results = [summarize('exact', truth, latencies, truth, exact.embeddings.nbytes, exact.embeddings.nbytes)]
+
+    for pq_m in (int(m) for m in args.pq_m.split(',')):
+        started_at = time.time()
+        index = IVFIndex(nlist=args.nlist, pq_m=pq_m or None, rerank=args.rerank if pq_m else 0)
+        index.fit(catalog, n_iter=args.iterations)
+        index.attach_embeddings(catalog)
+        logger.info(f"Trained IVF (pq_m={pq_m}) in {time.time() - started_at:.1f}s")
+
+        for nprobe in (int(n) for n in args.nprobe.split(',')):
+            index.nprobe = nprobe
+            indices, latencies = timed_search(index, queries, top_k)
+            name = f'ivf-pq{pq_m}' if pq_m else 'ivf-flat'
+            results.append(summarize(name, indices, latencies, truth, index.nbytes,
+                                     index.serving_nbytes(catalog.nbytes), nlist=index.nlist,
+                                     nprobe=nprobe, rerank=index.rerank))
+
+    print(f"{'backend':<12}{'nprobe':>8}{'recall@5':>10}{'recall@10':>11}{'mean ms':>10}{'p95 ms':>9}"
+          f"{'index MiB':>11}{'serve MiB':>11}")
+    for r in results:
+        print(f"{r['backend']:<12}{r.get('nprobe', '-'):>8}{r['recall_at_5']:>10.3f}{r['recall_at_10']:>11.3f}"
+              f"{r['latency_ms_mean']:>10.3f}{r['latency_ms_p95']:>9.3f}{r['index_mib']:>11.1f}"
+              f"{r['serving_mib']:>11.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'catalog_size': len(catalog), 'dim': catalog.shape[1], 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,303 @@
+import argparse
+import http.client
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+
+from index_bundle import save_index_bundle
+
+logger = logging.getLogger(__name__)
+
+# Metrics where a larger value is better; every other numeric metric is treated as lower-is-better
+HIGHER_IS_BETTER = ('throughput_rps',)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the recommendation service end to end and per stage')
+    parser.add_argument("--work_dir", type=str, default="benchmark_data")
+    parser.add_argument("--catalog_size", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=0, help="Embedding size; 0 probes the model's output size")
+    parser.add_argument("--stub_images", type=int, default=200)
+    parser.add_argument("--stage_iterations", type=int, default=200)
+    parser.add_argument("--skip_stages", action="store_true")
+    parser.add_argument("--skip_load", action="store_true")
+    parser.add_argument("--url", type=str, default=None,
+                        help="Drive an already running server instead of starting one on the synthetic catalog")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--output", type=str, default="benchmark_results.json")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    parser.add_argument("--error_rate_tolerance", type=float, default=0.01,
+                        help="Allowed absolute increase of the load test's error rate")
+    return parser.parse_args()
+
+
+def percentiles_ms(timings):
+    if not len(timings):
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    timings = np.asarray(timings) * 1000
+    return {
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'p99_ms': float(np.percentile(timings, 99)),
+    }
+
+
+def probe_embedding_dim(model_path):
+    import joblib
+    from image_preprocessing import preprocess_batch
+    model = joblib.load(model_path)
+    return int(model.predict(preprocess_batch(np.zeros((1, 80, 80, 3), dtype=np.uint8))).reshape(1, -1).shape[1])
+
+
+# Write stub catalog JPEGs and an index bundle of random unit vectors, generated in chunks so
+# catalogs of a million vectors never need to be held in memory at once
+def build_synthetic_catalog(work_dir, catalog_size, dim, stub_images, seed=0):
+    bundle_dir = os.path.join(work_dir, 'index_bundle')
+    image_dir = os.path.join(work_dir, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    for i in range(min(stub_images, catalog_size)):
+        path = os.path.join(image_dir, f'{i}.jpg')
+        if not os.path.exists(path):
+            cv2.imwrite(path, rng.integers(0, 256, (240, 180, 3), dtype=np.uint8))
+
+    raw_path = os.path.join(work_dir, 'synthetic_embeddings.npy')
+    embeddings = np.lib.format.open_memmap(raw_path, mode='w+', dtype=np.float32, shape=(catalog_size, dim))
+    for start in range(0, catalog_size, 65536):
+        block = rng.standard_normal((min(65536, catalog_size - start), dim)).astype(np.float32)
+        embeddings[start:start + len(block)] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    embeddings.flush()
+
+    save_index_bundle(bundle_dir, embeddings, [f'{i}.jpg' for i in range(catalog_size)], normalized=True)
+    del embeddings
+    os.remove(raw_path)
+    return bundle_dir, image_dir
+
+
+def stub_upload_bytes(image_dir, count):
+    names = sorted(os.listdir(image_dir))[:count]
+    uploads = []
+    for name in names:
+        with open(os.path.join(image_dir, name), 'rb') as f:
+            uploads.append(f.read())
+    return uploads
+
+
+def time_stage(fn, inputs, iterations):
+    fn(inputs[0])
+    timings = []
+    for i in range(iterations):
+        item = inputs[i % len(inputs)]
+        started_at = time.perf_counter()
+        fn(item)
+        timings.append(time.perf_counter() - started_at)
+    return percentiles_ms(timings)
+
+
+# Time each stage of a /recommend call in-process, using the server's own functions
+def benchmark_stages(bundle_dir, uploads, iterations):
+    # app.py reads its settings at import; the stub uploads repeat, so the query cache is off
+    # unless explicitly configured (setdefault keeps the user's value for start_server too)
+    os.environ['FASHION_INDEX_DIR'] = bundle_dir
+    os.environ['FASHION_RELOAD_INTERVAL'] = '0'
+    os.environ.setdefault('FASHION_CACHE_SIZE', '0')
+    import app
+
+    images = [app.load_query_image(data) for data in uploads]
+    features = app.extract_image_features(images[:1])
+    search_index = app.catalog.search_index
+    similar_image_indices, _ = search_index.search_batch(features, top_k=app.top_n)
+
+    return {
+        'decode_resize': time_stage(app.load_query_image, uploads, iterations),
+        'extract_image_features': time_stage(lambda img: app.extract_image_features([img]), images, iterations),
+        'similarity_search': time_stage(lambda f: search_index.search_batch(f, top_k=app.top_n), [features], iterations),
+        'result_mapping': time_stage(lambda row: [app.catalog.filenames[idx] for idx in row if idx >= 0],
+                                     list(similar_image_indices), iterations),
+    }
+
+
+def multipart_body(data):
+    boundary = uuid.uuid4().hex
+    body = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="query.jpg"\r\n'
+            f'Content-Type: image/jpeg\r\n\r\n').encode('ascii') + data + f'\r\n--{boundary}--\r\n'.encode('ascii')
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+# Fire total_requests POST /recommend calls from `concurrency` threads, each with its own
+# keep-alive connection, cycling through the stub uploads. Latency percentiles and throughput
+# count successful (200) responses only, so a server shedding load with fast 503s does not
+# look faster; failures show up in the error rate instead.
+def run_load(url, uploads, concurrency, total_requests):
+    target = urlparse(url)
+    bodies = [multipart_body(data) for data in uploads]
+    counter = iter(range(total_requests))
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+
+    def worker():
+        connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                break
+            body, content_type = bodies[i % len(bodies)]
+            started_at = time.perf_counter()
+            try:
+                connection.request('POST', '/recommend', body=body, headers={'Content-Type': content_type})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(target.hostname, target.port or 80, timeout=60)
+                status = 'connection_error'
+            elapsed = time.perf_counter() - started_at
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+        connection.close()
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(worker)
+    duration = time.perf_counter() - started_at
+    return {
+        'requests': total_requests,
+        'concurrency': concurrency,
+        'throughput_rps': len(latencies) / duration,
+        'error_rate': (total_requests - len(latencies)) / max(total_requests, 1),
+        'statuses': statuses,
+        **percentiles_ms(latencies),
+    }
+
+
+def peak_rss_bytes(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def wait_until_up(url, process, timeout=300):
+    target = urlparse(url)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            connection = http.client.HTTPConnection(target.hostname, target.port, timeout=2)
+            connection.request('GET', '/ready')
+            response = connection.getresponse()
+            response.read()
+            if response.status == 200:
+                return
+            time.sleep(0.5)
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError(f"Server did not come up within {timeout}s")
+
+
+def start_server(bundle_dir, port):
+    # The stub uploads repeat, so the query cache is off unless explicitly configured
+    env = dict(os.environ, FASHION_INDEX_DIR=os.path.abspath(bundle_dir), FASHION_RELOAD_INTERVAL='0')
+    env.setdefault('FASHION_CACHE_SIZE', '0')
+    code = f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"
+    return subprocess.Popen([sys.executable, '-c', code], env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+# Metrics that got worse than the baseline by more than the tolerance. Error rates are compared
+# by absolute increase, since a baseline rate is usually 0; a run with no successful requests
+# at all has no latencies to compare but still fails on its error rate.
+def find_regressions(results, baseline, tolerance, error_rate_tolerance=0.01):
+    current, previous = flatten(results), flatten(baseline)
+    regressions = []
+    for key, new in current.items():
+        if key.split('.')[-1] == 'error_rate':
+            old = previous.get(key, 0.0)
+            if new - old > error_rate_tolerance:
+                regressions.append({'metric': key, 'baseline': old, 'current': new, 'change': new - old})
+    for key, old in previous.items():
+        new = current.get(key)
+        if new is None or old == 0 or not key.split('.')[-1].endswith(('_ms', '_rps', '_bytes')):
+            continue
+        change = (new - old) / abs(old)
+        worse = change < -tolerance if key.split('.')[-1] in HIGHER_IS_BETTER else change > tolerance
+        if worse:
+            regressions.append({'metric': key, 'baseline': old, 'current': new, 'change': change})
+    return regressions
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    dim = args.dim or probe_embedding_dim(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_80x80.pkl'))
+    logger.info(f"Generating a synthetic catalog of {args.catalog_size} x {dim}")
+    bundle_dir, image_dir = build_synthetic_catalog(args.work_dir, args.catalog_size, dim, args.stub_images)
+    uploads = stub_upload_bytes(image_dir, args.stub_images)
+
+    results = {'catalog_size': args.catalog_size, 'dim': dim}
+    if not args.skip_stages:
+        results['stages'] = benchmark_stages(bundle_dir, uploads, args.stage_iterations)
+
+    if not args.skip_load:
+        if args.url:
+            results['load'] = run_load(args.url, uploads, args.concurrency, args.requests)
+        else:
+            url = f'http://127.0.0.1:{args.port}'
+            server = start_server(bundle_dir, args.port)
+            try:
+                wait_until_up(url, server)
+                results['load'] = run_load(url, uploads, args.concurrency, args.requests)
+                results['load']['server_peak_rss_bytes'] = peak_rss_bytes(server.pid)
+            finally:
+                server.terminate()
+                server.wait()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['regressions'] = find_regressions(results, json.load(f), args.tolerance,
+                                                      args.error_rate_tolerance)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if results.get('regressions'):
+        for regression in results['regressions']:
+            logger.error(f"Regression in {regression['metric']}: {regression['baseline']:.3f} -> "
+                         f"{regression['current']:.3f} ({regression['change']:+.1%})")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from functools import partial
+
+import joblib
+import numpy as np
+
+from image_preprocessing import load_and_resize, preprocess_batch, TARGET_SIZE
+from image_store import load_image_store
+from index_bundle import model_fingerprint, save_index_bundle, DEFAULT_PREPROCESSING, SUPPORTED_DTYPES
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = 'checkpoint.json'
+PARTIAL_EMBEDDINGS_FILE = 'embeddings.partial.npy'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Embed the image catalog and write an index bundle')
+    parser.add_argument("--image_dir", type=str, default="images")
+    parser.add_argument("--image_store", type=str, default=None,
+                        help="Read pre-resized images from a store packed by image_store.py instead of --image_dir")
+    parser.add_argument("--model", type=str, default="model_80x80.pkl")
+    parser.add_argument("--output", type=str, default="index_bundle")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--checkpoint_every", type=int, default=20, help="Checkpoint every N batches")
+    parser.add_argument("--dtype", type=str, default="float32", choices=SUPPORTED_DTYPES)
+    return parser.parse_args()
+
+
+def list_catalog_images(image_dir):
+    return sorted(os.path.basename(p) for p in glob.glob(os.path.join(image_dir, '*.jpg')))
+
+
+def _load_image(filename, image_dir, target_size):
+    return load_and_resize(os.path.join(image_dir, filename), target_size)
+
+
+def _read_checkpoint(work_dir):
+    path = os.path.join(work_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_checkpoint(work_dir, checkpoint):
+    tmp_path = os.path.join(work_dir, CHECKPOINT_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, os.path.join(work_dir, CHECKPOINT_FILE))
+
+
+# Stream the catalog through the model in fixed-size batches. Images are decoded and resized
+# by a process pool while the main process runs inference; embeddings are written straight into
+# a memory-mapped .npy file and a checkpoint records how many rows are done, so an interrupted
+# run resumes from the last checkpoint instead of starting over. With an image store, images are
+# read sequentially from its memory-mapped array instead of being decoded.
+def build_embeddings(filenames, image_dir, model, work_dir, batch_size=256, workers=None,
+                     checkpoint_every=20, target_size=TARGET_SIZE, fingerprint=None, image_store=None):
+    os.makedirs(work_dir, exist_ok=True)
+    partial_path = os.path.join(work_dir, PARTIAL_EMBEDDINGS_FILE)
+    total = len(filenames)
+
+    checkpoint = _read_checkpoint(work_dir)
+    if checkpoint and (checkpoint['filenames'] != filenames or checkpoint['model_fingerprint'] != fingerprint):
+        logger.warning("Checkpoint does not match the current catalog or model; starting over")
+        checkpoint = None
+
+    if checkpoint:
+        embeddings = np.lib.format.open_memmap(partial_path, mode='r+')
+        valid = np.array(checkpoint['valid'], dtype=bool)
+        start = checkpoint['rows_done']
+        logger.info(f"Resuming from row {start}/{total}")
+    else:
+        embeddings = None
+        valid = np.zeros(total, dtype=bool)
+        start = 0
+
+    def save_progress(rows_done):
+        embeddings.flush()
+        _write_checkpoint(work_dir, {
+            'filenames': filenames,
+            'model_fingerprint': fingerprint,
+            'rows_done': rows_done,
+            'valid': valid.tolist(),
+        })
+
+    if image_store is not None and image_store.target_size != tuple(target_size):
+        raise ValueError(f"Image store holds {image_store.target_size} images, the model needs {tuple(target_size)}")
+
+    load = partial(_load_image, image_dir=image_dir, target_size=target_size)
+    started_at = time.time()
+    processed = 0
+    batches_since_checkpoint = 0
+
+    with contextlib.ExitStack() as stack:
+        if image_store is not None:
+            images = (image_store.get(name) for name in filenames[start:])
+        else:
+            # Spawned (not forked) workers so the decode pool does not inherit TensorFlow's thread state
+            pool = stack.enter_context(multiprocessing.get_context('spawn').Pool(workers))
+            images = pool.imap(load, filenames[start:], chunksize=max(1, batch_size // (workers or 1)))
+        row = start
+        while row < total:
+            batch_rows, batch_images = [], []
+            for offset in range(min(batch_size, total - row)):
+                img = next(images)
+                if img is None:
+                    logger.warning(f"Could not read image: {filenames[row + offset]}")
+                    continue
+                batch_rows.append(row + offset)
+                batch_images.append(img)
+
+            if batch_images:
+                features = model.predict(preprocess_batch(np.stack(batch_images)), verbose=0)
+                features = features.reshape(len(batch_images), -1)
+                if embeddings is None:
+                    embeddings = np.lib.format.open_memmap(partial_path, mode='w+', dtype=np.float32,
+                                                           shape=(total, features.shape[1]))
+                embeddings[batch_rows] = features
+                valid[batch_rows] = True
+
+            batch_end = min(row + batch_size, total)
+            processed += batch_end - row
+            row = batch_end
+            batches_since_checkpoint += 1
+            if embeddings is not None and (batches_since_checkpoint >= checkpoint_every or row == total):
+                save_progress(row)
+                batches_since_checkpoint = 0
+
+            elapsed = time.time() - started_at
+            sys.stdout.write(f"\rProgress: {row}/{total} ({row / total * 100:.2f}%) "
+                             f"{processed / elapsed:.1f} images/s")
+            sys.stdout.flush()
+
+    print()
+    elapsed = time.time() - started_at
+    logger.info(f"Embedded {processed} images in {elapsed:.1f}s ({processed / max(elapsed, 1e-9):.1f} images/s)")
+    if embeddings is None:
+        raise ValueError(f"No readable images found in {image_dir}")
+    return embeddings, valid
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    image_store = load_image_store(args.image_store) if args.image_store else None
+    filenames = image_store.filenames if image_store else list_catalog_images(args.image_dir)
+    if not filenames:
+        print(f"No images found in {args.image_store or args.image_dir}")
+        return
+
+    fingerprint = model_fingerprint(args.model)
+    work_dir = args.output + '.partial'
+
+    model = joblib.load(args.model)
+
+    embeddings, valid = build_embeddings(filenames, args.image_dir, model, work_dir,
+                                         batch_size=args.batch_size, workers=args.workers,
+                                         checkpoint_every=args.checkpoint_every, fingerprint=fingerprint,
+                                         image_store=image_store)
+
+    kept = np.flatnonzero(valid)
+    save_index_bundle(args.output, embeddings[kept], [filenames[i] for i in kept], model_path=args.model,
+                      preprocessing=DEFAULT_PREPROCESSING, dtype=args.dtype)
+    logger.info(f"Skipped {len(filenames) - len(kept)} unreadable images")
+
+    os.remove(os.path.join(work_dir, PARTIAL_EMBEDDINGS_FILE))
+    os.remove(os.path.join(work_dir, CHECKPOINT_FILE))
+    os.rmdir(work_dir)
+
+
+if __name__ == '__main__':
+    main()
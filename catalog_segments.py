@@ -0,0 +1,386 @@
+import argparse
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from attribute_index import AttributeIndex, ATTRIBUTES_FILE, attributes_for_ids, load_styles
+from embedding_projection import load_bundle_projection, PROJECTION_MANIFEST_KEY
+from index_bundle import load_index_bundle, read_manifest, save_index_bundle, MANIFEST_FILE
+from similarity_search import create_search_index, normalize_rows, search_rows, top_k_indices
+
+logger = logging.getLogger(__name__)
+
+DELTA_FILE = 'delta.json'
+LOCK_FILE = '.catalog.lock'
+
+# The catalog is the base index bundle plus a small delta segment stored next to it:
+#   delta.json         ids/filenames of items added since the base was built, their filter
+#                      attributes, the embeddings file holding their vectors, and the base
+#                      rows that have been removed
+#   delta-*.npy        normalized embeddings of the added items
+# Every file is written under a new name and the JSON manifest is swapped in last, so a
+# reader always sees a consistent segment. A delta applies only to the base version it was
+# written against; once compaction folds it into a new base it is ignored automatically.
+
+
+@contextmanager
+def catalog_lock(path):
+    with open(os.path.join(path, LOCK_FILE), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def empty_delta(base_version):
+    return {'base_version': base_version, 'delta_version': 0, 'embeddings_file': None,
+            'ids': [], 'filenames': [], 'attributes': [], 'removed_base_rows': []}
+
+
+# Filter attributes of the added items, aligned with delta['ids']
+def delta_attributes(delta):
+    return delta.get('attributes') or [{} for _ in delta['ids']]
+
+
+def read_delta(path, base_version):
+    delta_path = os.path.join(path, DELTA_FILE)
+    if not os.path.exists(delta_path):
+        return empty_delta(base_version)
+    with open(delta_path) as f:
+        delta = json.load(f)
+    if delta['base_version'] != base_version:
+        return empty_delta(base_version)
+    return delta
+
+
+def load_delta_embeddings(path, delta, dim):
+    if not delta['embeddings_file']:
+        return np.empty((0, dim), dtype=np.float32)
+    return np.load(os.path.join(path, delta['embeddings_file']))
+
+
+def write_delta(path, delta, embeddings):
+    delta = dict(delta, delta_version=delta['delta_version'] + 1, embeddings_file=None)
+    if len(embeddings):
+        delta['embeddings_file'] = f"delta-{delta['base_version']}-{delta['delta_version']}.npy"
+        tmp_path = os.path.join(path, delta['embeddings_file'] + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(embeddings, dtype=np.float32))
+        os.replace(tmp_path, os.path.join(path, delta['embeddings_file']))
+
+    tmp_path = os.path.join(path, DELTA_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(delta, f)
+    os.replace(tmp_path, os.path.join(path, DELTA_FILE))
+
+    for stale in glob.glob(os.path.join(path, 'delta-*.npy')):
+        if os.path.basename(stale) != delta['embeddings_file']:
+            os.remove(stale)
+    return delta
+
+
+def _drop_ids(manifest, delta, embeddings, ids):
+    ids = set(ids)
+    removed = set(delta['removed_base_rows'])
+    removed.update(row for row, image_id in enumerate(manifest['ids']) if image_id in ids)
+    keep = [i for i, image_id in enumerate(delta['ids']) if image_id not in ids]
+    attributes = delta_attributes(delta)
+    delta = dict(delta, removed_base_rows=sorted(removed), ids=[delta['ids'][i] for i in keep],
+                 filenames=[delta['filenames'][i] for i in keep], attributes=[attributes[i] for i in keep])
+    return delta, embeddings[keep]
+
+
+# Retire catalog items by id. Base rows are tombstoned; delta rows are dropped.
+def remove_items(path, ids):
+    with catalog_lock(path):
+        manifest = read_manifest(path)
+        delta = read_delta(path, manifest['index_version'])
+        embeddings = load_delta_embeddings(path, delta, manifest['dim'])
+        delta, embeddings = _drop_ids(manifest, delta, embeddings, [str(i) for i in ids])
+        return write_delta(path, delta, embeddings)
+
+
+# Append items to the delta segment. Re-adding an existing id replaces the old entry.
+# Embeddings are raw model outputs; a projected bundle applies its projection to them.
+# attributes holds one item_attributes() dict per item, so filtered queries find the new
+# items before the next compaction; items without attributes only show up unfiltered.
+def add_items(path, embeddings, filenames, ids=None, attributes=None):
+    filenames = [os.path.basename(f) for f in filenames]
+    ids = [str(i) for i in ids] if ids is not None else [os.path.splitext(f)[0] for f in filenames]
+    attributes = list(attributes) if attributes is not None else [{} for _ in ids]
+    with catalog_lock(path):
+        manifest = read_manifest(path)
+        projection = load_bundle_projection(path, manifest)
+        embeddings = normalize_rows(projection.transform(embeddings) if projection else embeddings)
+        if embeddings.shape[1] != manifest['dim']:
+            raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match index ({manifest['dim']})")
+        delta = read_delta(path, manifest['index_version'])
+        existing = load_delta_embeddings(path, delta, manifest['dim'])
+        delta, existing = _drop_ids(manifest, delta, existing, ids)
+        delta = dict(delta, ids=delta['ids'] + ids, filenames=delta['filenames'] + filenames,
+                     attributes=delta['attributes'] + attributes)
+        return write_delta(path, delta, np.vstack([existing, embeddings]))
+
+
+# Fold the delta segment and tombstones into a new base bundle. Attribute posting lists are
+# rebuilt when styles.csv is given, otherwise the existing ones are carried over: kept base
+# rows are renumbered and the added items' attributes appended. An IVF index must be
+# retrained with ann_index.py (until then the server falls back to exact search).
+def compact(path, styles_path=None):
+    with catalog_lock(path):
+        bundle = load_index_bundle(path)
+        delta = read_delta(path, bundle.version)
+        delta_embeddings = load_delta_embeddings(path, delta, bundle.manifest['dim'])
+
+        keep = np.ones(len(bundle), dtype=bool)
+        keep[np.asarray(delta['removed_base_rows'], dtype=np.int64)] = False
+        rows = np.flatnonzero(keep)
+        embeddings = np.vstack([np.asarray(bundle.embeddings[rows], dtype=np.float32), delta_embeddings])
+        filenames = [bundle.filenames[i] for i in rows] + delta['filenames']
+        ids = [bundle.ids[i] for i in rows] + delta['ids']
+
+        attributes_path = os.path.join(path, ATTRIBUTES_FILE)
+        attribute_index = None
+        if not styles_path and os.path.exists(attributes_path):
+            attribute_index = AttributeIndex.load(attributes_path)
+            if attribute_index.source_version not in (None, bundle.version):
+                logger.warning("Attribute index was built for a different index version; pass --styles to rebuild it")
+                attribute_index = None
+
+        extra = {k: bundle.manifest[k] for k in (PROJECTION_MANIFEST_KEY,) if k in bundle.manifest}
+        manifest = save_index_bundle(path, embeddings, filenames, ids=ids, preprocessing=bundle.preprocessing,
+                                     dtype=bundle.manifest['dtype'], fingerprint=bundle.model_fingerprint,
+                                     extra=extra)
+
+        # Saved before the delta is reset, so the reload that change triggers sees the new attributes
+        if styles_path:
+            attribute_index = AttributeIndex.build(load_styles(styles_path), ids)
+        elif attribute_index is not None:
+            new_rows = np.full(len(bundle), -1, dtype=np.int64)
+            new_rows[rows] = np.arange(len(rows))
+            attribute_index = attribute_index.remap(new_rows, len(rows)).extend(delta_attributes(delta))
+        if attribute_index is not None:
+            attribute_index.source_version = manifest['index_version']
+            attribute_index.save(attributes_path)
+        write_delta(path, empty_delta(manifest['index_version']), delta_embeddings[:0])
+        logger.info(f"Compacted {len(bundle)} base rows, {len(delta['ids'])} added and "
+                    f"{len(delta['removed_base_rows'])} removed into {manifest['count']} rows")
+        return manifest
+
+
+# Searches the base index and the delta segment together. Tombstoned base rows are skipped by
+# over-fetching from the base by the number of tombstones; delta rows are numbered after the
+# base rows and scanned exactly (the delta is small until the next compaction).
+class SegmentedSearchIndex:
+    def __init__(self, base_index, delta_embeddings, removed_base_rows):
+        self.base_index = base_index
+        self.delta_embeddings = delta_embeddings
+        self.num_base = len(base_index.embeddings)
+        self.removed = np.zeros(self.num_base, dtype=bool)
+        self.removed[np.asarray(removed_base_rows, dtype=np.int64)] = True
+        self.num_removed = int(self.removed.sum())
+
+    def __len__(self):
+        return self.num_base - self.num_removed + len(self.delta_embeddings)
+
+    @property
+    def dim(self):
+        return self.base_index.dim
+
+    @property
+    def embeddings(self):
+        return self.base_index.embeddings
+
+    def search_batch(self, queries, top_k=5):
+        if not self.num_removed and not len(self.delta_embeddings):
+            return self.base_index.search_batch(queries, top_k)
+
+        queries = normalize_rows(queries)
+        indices, scores = self.base_index.search_batch(queries, top_k + self.num_removed)
+        dead = (indices < 0) | self.removed[np.clip(indices, 0, None)]
+        scores = np.where(dead, -np.inf, scores)
+
+        if len(self.delta_embeddings):
+            delta_scores = queries @ self.delta_embeddings.T
+            indices = np.hstack([indices, np.arange(self.num_base, self.num_base + len(self.delta_embeddings))
+                                 [np.newaxis, :].repeat(len(queries), axis=0)])
+            scores = np.hstack([scores, delta_scores])
+
+        best = top_k_indices(scores, top_k)
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        best_indices = np.where(np.isinf(best_scores), -1, np.take_along_axis(indices, best, axis=1))
+        return best_indices, best_scores
+
+    def search(self, query, top_k=5):
+        indices, scores = self.search_batch(query, top_k)
+        return indices[0], scores[0]
+
+    # Rows come from the attribute index: base rows minus tombstones are scored by the base
+    # index, delta rows (numbered after the base) against the delta embeddings
+    def search_rows(self, query, rows, top_k=5):
+        base_rows = rows[rows < self.num_base]
+        base_rows = base_rows[~self.removed[base_rows]]
+        delta_rows = rows[rows >= self.num_base]
+        if not len(delta_rows):
+            return search_rows(self.base_index, query, base_rows, top_k)
+
+        indices, scores = search_rows(self.base_index, query, base_rows, top_k)
+        delta_scores = self.delta_embeddings[delta_rows - self.num_base] @ normalize_rows(query)[0]
+        indices = np.concatenate([indices, delta_rows])
+        scores = np.concatenate([scores, delta_scores])
+        best = top_k_indices(scores, top_k)[0]
+        return indices[best], scores[best]
+
+
+# One immutable snapshot of the catalog: search index, row -> filename mapping, attribute
+# index and the projection (see embedding_projection.py) its vectors were reduced with. The
+# server swaps whole generations, and each request keeps using the generation it started with,
+# so a reload never mixes rows of one generation with filenames of another.
+class CatalogGeneration:
+    def __init__(self, bundle, delta, search_index, attribute_index, projection=None):
+        self.bundle = bundle
+        self.delta = delta
+        self.search_index = search_index
+        self.attribute_index = attribute_index
+        self.projection = projection
+        self.filenames = bundle.filenames + delta['filenames']
+        self.version = f"{bundle.version}.{delta['delta_version']}"
+
+    def __len__(self):
+        return len(self.search_index)
+
+    # Map raw model outputs into the space this catalog is searched in
+    def project(self, features):
+        return self.projection.transform(features) if self.projection is not None else features
+
+
+def load_catalog_generation(path, backend='exact', nprobe=None):
+    bundle = load_index_bundle(path)
+    delta = read_delta(path, bundle.version)
+    delta_embeddings = load_delta_embeddings(path, delta, bundle.manifest['dim'])
+    search_index = SegmentedSearchIndex(create_search_index(bundle, backend=backend, nprobe=nprobe),
+                                        delta_embeddings, delta['removed_base_rows'])
+
+    attributes_path = os.path.join(path, ATTRIBUTES_FILE)
+    attribute_index = AttributeIndex.load(attributes_path) if os.path.exists(attributes_path) else None
+    if attribute_index is not None and attribute_index.source_version not in (None, bundle.version):
+        logger.warning("Attribute index was built for a different index version; attribute filters are disabled")
+        attribute_index = None
+    if attribute_index is not None and delta['ids']:
+        attribute_index = attribute_index.extend(delta_attributes(delta))
+    return CatalogGeneration(bundle, delta, search_index, attribute_index,
+                             load_bundle_projection(path, bundle.manifest))
+
+
+# Polls the bundle and delta manifests and calls on_reload with a freshly loaded generation
+# whenever either changes. A failed load is logged and retried on the next poll.
+class CatalogReloader:
+    def __init__(self, path, load_generation, on_reload, interval=30.0):
+        self.path = path
+        self.load_generation = load_generation
+        self.on_reload = on_reload
+        self.interval = interval
+        self._state = self._current_state()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='catalog-reloader', daemon=True)
+
+    def _current_state(self):
+        state = []
+        for name in (MANIFEST_FILE, DELTA_FILE):
+            try:
+                state.append(os.stat(os.path.join(self.path, name)).st_mtime_ns)
+            except FileNotFoundError:
+                state.append(None)
+        return tuple(state)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        state = self._current_state()
+        if state == self._state:
+            return False
+        try:
+            generation = self.load_generation()
+        except Exception:
+            logger.exception('Failed to load the updated catalog; keeping the current generation')
+            return False
+        self._state = state
+        self.on_reload(generation)
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+
+def _embed_images(image_paths, model_path, batch_size=256):
+    import joblib
+    from image_preprocessing import load_and_resize, preprocess_batch
+
+    model = joblib.load(model_path)
+    images, filenames = [], []
+    for image_path in image_paths:
+        img = load_and_resize(image_path)
+        if img is None:
+            logger.warning(f"Could not read image: {image_path}")
+            continue
+        images.append(img)
+        filenames.append(os.path.basename(image_path))
+    if not images:
+        raise ValueError("None of the given images could be read")
+    features = [model.predict(preprocess_batch(np.stack(images[i:i + batch_size])))
+                for i in range(0, len(images), batch_size)]
+    return np.vstack(features).reshape(len(images), -1), filenames
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Apply catalog changes to an index bundle')
+    parser.add_argument("--bundle", type=str, default="index_bundle")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="Embed images and append them to the delta segment")
+    add_parser.add_argument("images", nargs="+")
+    add_parser.add_argument("--model", type=str, default="model_80x80.pkl")
+    add_parser.add_argument("--styles", type=str, default=None,
+                            help="styles.csv holding the new items' filter attributes")
+
+    remove_parser = subparsers.add_parser("remove", help="Retire items by id")
+    remove_parser.add_argument("ids", nargs="+")
+
+    compact_parser = subparsers.add_parser("compact", help="Merge the delta segment into a new base bundle")
+    compact_parser.add_argument("--styles", type=str, default=None, help="styles.csv for rebuilding filters")
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    if args.command == "add":
+        embeddings, filenames = _embed_images(args.images, args.model)
+        attributes = None
+        if args.styles:
+            attributes = attributes_for_ids(load_styles(args.styles), [os.path.splitext(f)[0] for f in filenames])
+        delta = add_items(args.bundle, embeddings, filenames, attributes=attributes)
+        logger.info(f"Delta {delta['delta_version']} holds {len(delta['ids'])} added items")
+    elif args.command == "remove":
+        delta = remove_items(args.bundle, args.ids)
+        logger.info(f"Delta {delta['delta_version']} tombstones {len(delta['removed_base_rows'])} base rows")
+    else:
+        compact(args.bundle, styles_path=args.styles)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,201 @@
 # data_preparation.py - Updated
 
-import pandas as pd
+import argparse
+import hashlib
+import json
 import os
 import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import boto3
+import pandas as pd
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
 from sklearn.model_selection import train_test_split
-import sys
 
-def split_dataset_and_upload_to_s3(csv_file_path, root_directory, s3_bucket_name):
+MANIFEST_FILE = '.sync_manifest.json'
+MULTIPART_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Split the dataset into train/val and sync it to S3')
+    parser.add_argument("--csv", type=str, default="styles.csv")
+    parser.add_argument("--images_folder", type=str, default="images", help="Directory holding <id>.jpg")
+    parser.add_argument("--root_directory", type=str, default="images", help="Where 'train' and 'val' are created")
+    parser.add_argument("--bucket", type=str, default="image-recommendation-dataset")
+    parser.add_argument("--endpoint_url", type=str, default=os.environ.get('S3_ENDPOINT_URL'),
+                        help="S3-compatible endpoint, e.g. a local stand-in such as MinIO or moto_server")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--copy", action="store_true", help="Always copy files instead of hard-linking them")
+    return parser.parse_args()
+
+
+def progress(label, done, total):
+    sys.stdout.write(f"\r{label}: {done}/{total} ({done / max(total, 1) * 100:.2f}%)")
+    sys.stdout.flush()
+
+
+# md5 of a file and the ETag S3 gives it when uploaded with our TransferConfig: the plain md5
+# below the multipart threshold, otherwise the md5 of the concatenated part digests plus "-<parts>"
+def file_checksums(path):
+    digest = hashlib.md5()
+    part_digests = []
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MULTIPART_CHUNK_BYTES), b''):
+            digest.update(chunk)
+            part_digests.append(hashlib.md5(chunk).digest())
+    md5 = digest.hexdigest()
+    if os.path.getsize(path) < MULTIPART_CHUNK_BYTES:
+        return md5, md5
+    return md5, f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+# Local cache of checksums: size, mtime, md5 and expected S3 ETag of every local file, and the
+# size and md5 of what was last uploaded for each S3 key. A rerun rehashes only files whose
+# size or mtime changed. Whether a file needs uploading is decided against the bucket listing,
+# so a fresh checkout with no manifest still skips objects that are already in S3.
+class SyncManifest:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        self.files = data.get('files', {})
+        self.uploaded = data.get('uploaded', {})
+
+    # (size, md5, etag) of a local file, reusing the stored checksums while size and mtime are unchanged
+    def checksum(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            entry = self.files.get(key)
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns and 'etag' in entry:
+            return entry['size'], entry['md5'], entry['etag']
+        md5, etag = file_checksums(path)
+        with self._lock:
+            self.files[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'md5': md5, 'etag': etag}
+        return stat.st_size, md5, etag
+
+    def record_upload(self, bucket, key, size, md5):
+        with self._lock:
+            self.uploaded[f'{bucket}/{key}'] = {'size': size, 'md5': md5}
+
+    def last_upload(self, bucket, key):
+        with self._lock:
+            return self.uploaded.get(f'{bucket}/{key}')
+
+    def save(self):
+        with self._lock:
+            data = {'files': self.files, 'uploaded': self.uploaded}
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+
+# Hard-link (or copy) one image into a split folder, unless an identical file is already there
+def place_file(source_path, destination_path, manifest, use_links):
+    if not os.path.exists(source_path):
+        return 'missing'
+    if os.path.exists(destination_path):
+        if os.path.samefile(source_path, destination_path) or \
+                manifest.checksum(source_path) == manifest.checksum(destination_path):
+            return 'skipped'
+        os.remove(destination_path)
+    if use_links:
+        try:
+            os.link(source_path, destination_path)
+            return 'linked'
+        except OSError:
+            # Different filesystem, or links are not supported there
+            pass
+    shutil.copy2(source_path, destination_path)
+    return 'copied'
+
+
+def copy_images_to_folder(image_ids, images_folder, destination_folder, manifest, workers, use_links=True):
+    os.makedirs(destination_folder, exist_ok=True)
+    filenames = [f'{image_id}.jpg' for image_id in image_ids]
+    counts = {}
+    with ThreadPoolExecutor(workers) as pool:
+        futures = [pool.submit(place_file, os.path.join(images_folder, name),
+                               os.path.join(destination_folder, name), manifest, use_links)
+                   for name in filenames]
+        for i, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            counts[result] = counts.get(result, 0) + 1
+            if i % 500 == 0 or i == len(futures):
+                progress(f"Placing images in {destination_folder}", i, len(futures))
+    print(f"\nImage copying completed: {counts}")
+
+
+# Every key under the prefix with its (size, ETag), following continuation tokens past 1000 keys
+def list_bucket(s3, bucket, prefix):
+    objects = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            objects[obj['Key']] = (obj['Size'], obj.get('ETag', '').strip('"'))
+    return objects
+
+
+def upload_folder(s3, local_folder, bucket, prefix, manifest, workers, transfer_config):
+    remote = list_bucket(s3, bucket, prefix)
+
+    local_paths = [os.path.join(root, file) for root, _, files in os.walk(local_folder) for file in files]
+    with ThreadPoolExecutor(workers) as pool:
+        checksums = list(pool.map(manifest.checksum, local_paths))
+
+    # Upload what is missing remotely or differs from the remote object. ETags that are not
+    # content hashes (e.g. SSE-KMS objects) fall back to the record of our last upload.
+    pending = []
+    skipped = 0
+    for local_path, (size, md5, etag) in zip(local_paths, checksums):
+        key = '/'.join([prefix, os.path.relpath(local_path, local_folder).replace(os.sep, '/')])
+        remote_size, remote_etag = remote.get(key, (None, None))
+        if remote_size == size and (remote_etag == etag or
+                                    manifest.last_upload(bucket, key) == {'size': size, 'md5': md5}):
+            skipped += 1
+        else:
+            pending.append((local_path, key, size, md5))
+
+    def upload(local_path, key, size, md5):
+        s3.upload_file(local_path, bucket, key, Config=transfer_config)
+        manifest.record_upload(bucket, key, size, md5)
+
+    uploaded, failed = 0, 0
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(upload, *item): item[0] for item in pending}
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    uploaded += 1
+                except NoCredentialsError:
+                    raise
+                except Exception as e:
+                    failed += 1
+                    print(f"\nError uploading {futures[future]} to S3 bucket: {str(e)}")
+                progress(f"Uploading {local_folder}", uploaded + failed, len(pending))
+        except NoCredentialsError:
+            for future in futures:
+                future.cancel()
+            print("\nError: AWS credentials not found. Please check your AWS credentials.")
+            raise
+        finally:
+            manifest.save()
+
+    print(f"\nUpload completed: {uploaded} uploaded, {skipped} unchanged, {failed} failed.")
+    return failed
+
+
+def split_dataset_and_upload_to_s3(csv_file_path, root_directory, s3_bucket_name, images_folder=None,
+                                   endpoint_url=None, workers=16, use_links=True):
     try:
         # Load the CSV file containing the dataset information
         df = pd.read_csv(csv_file_path, usecols=['id', 'gender', 'masterCategory', 'subCategory', 'articleType', 'baseColour', 'season', 'year', 'usage', 'productDisplayName'])
@@ -16,106 +203,44 @@ def split_dataset_and_upload_to_s3(csv_file_path, root_directory, s3_bucket_name
         print(f"Error parsing CSV file: {e}")
         return
 
-    # Create 'train' and 'val' directories
+    # Assuming the 'images' folder is located in the current directory unless given
+    images_folder = images_folder or os.path.join(os.getcwd(), 'images')
     train_dir = os.path.join(root_directory, 'train')
     val_dir = os.path.join(root_directory, 'val')
-    os.makedirs(train_dir, exist_ok=True)
-    os.makedirs(val_dir, exist_ok=True)
+    os.makedirs(root_directory, exist_ok=True)
+    manifest = SyncManifest(os.path.join(root_directory, MANIFEST_FILE))
 
     # Split the dataset into training and validation sets
     train_df, val_df = train_test_split(df, test_size=0.2, random_state=42)
 
-    # Function to copy images to the respective 'train' and 'val' folders
-    def copy_images_to_folders(dataframe, destination_folder):
-        current_directory = os.getcwd()
-        images_folder = os.path.join(current_directory, 'images')  # Assuming the 'images' folder is located in the current directory
-        total_images = len(dataframe)
-        skipped_images = 0
-
-        for i, (index, row) in enumerate(dataframe.iterrows(), 1):
-            image_filename = str(row['id']) + ".jpg"
-            image_source_path = os.path.join(images_folder, image_filename)
-            image_destination_path = os.path.join(destination_folder, image_filename)
-
-            # Check if the image file exists in the destination folder
-            if os.path.exists(image_destination_path):
-                skipped_images += 1
-                continue
-
-            # Check if the image file exists in the source folder before copying
-            if os.path.exists(image_source_path):
-                shutil.copy(image_source_path, image_destination_path)
-            else:
-                print(f"Image file not found: {image_source_path}")
-
-            # Calculate and display progress as a percentage
-            sys.stdout.write(f"\rProgress: {i}/{total_images} ({i / total_images * 100:.2f}%)")
-            sys.stdout.flush()
-
-        # Add a new line after the progress display is complete
-        print("\nImage copying completed!")
-        print(f"Skipped {skipped_images} duplicate images.")
-
-    # Copy images to 'train' and 'val' folders
-    copy_images_to_folders(train_df, train_dir)
-    copy_images_to_folders(val_df, val_dir)
-
-    # Upload 'train' and 'val' folders to AWS S3 bucket
-    def upload_to_s3(local_folder, s3_prefix):
-        s3 = boto3.client('s3')
-        total_files = sum(len(files) for _, _, files in os.walk(local_folder))
-        uploaded_files = 0
-        skipped_images = 0
-
-        # Get the list of already uploaded files in S3
-        s3_uploaded_files = set()
-        try:
-            response = s3.list_objects_v2(Bucket=s3_bucket_name, Prefix=s3_prefix)
-            for obj in response.get('Contents', []):
-                s3_uploaded_files.add(obj['Key'])
-        except Exception as e:
-            print(f"Error listing objects in S3: {str(e)}")
-
-        for root, _, files in os.walk(local_folder):
-            for file in files:
-                local_path = os.path.join(root, file)
-                relative_path = os.path.relpath(local_path, local_folder)
-                s3_path = os.path.join(s3_prefix, relative_path)
-
-                # Check if the image file is already uploaded in S3
-                if s3_path in s3_uploaded_files:
-                    skipped_images += 1
-                    continue
+    # Place images in the 'train' and 'val' folders
+    copy_images_to_folder(train_df['id'].astype(str), images_folder, train_dir, manifest, workers, use_links)
+    copy_images_to_folder(val_df['id'].astype(str), images_folder, val_dir, manifest, workers, use_links)
+    manifest.save()
 
-                try:
-                    s3.upload_file(local_path, s3_bucket_name, s3_path)
-                    uploaded_files += 1
+    # One client shared by all upload threads, with a connection pool large enough for them
+    s3 = boto3.client('s3', endpoint_url=endpoint_url, config=Config(max_pool_connections=workers * 2))
+    transfer_config = TransferConfig(multipart_threshold=MULTIPART_CHUNK_BYTES,
+                                     multipart_chunksize=MULTIPART_CHUNK_BYTES, max_concurrency=2)
+
+    # Replace 'train' and 'val' with appropriate prefixes if desired
+    failed = 0
+    try:
+        for local_folder, prefix in ((train_dir, 'train'), (val_dir, 'val')):
+            failed += upload_folder(s3, local_folder, s3_bucket_name, prefix, manifest, workers, transfer_config)
+    except NoCredentialsError:
+        return
+    return failed
 
-                    # Calculate and display progress as a percentage
-                    sys.stdout.write(f"\rProgress: {uploaded_files}/{total_files} ({uploaded_files / total_files * 100:.2f}%)")
-                    sys.stdout.flush()
 
-                except NoCredentialsError:
-                    print("\nError: AWS credentials not found. Please check your AWS credentials.")
-                    return
-                except Exception as e:
-                    print(f"\nError uploading {local_path} to S3 bucket: {str(e)}")
-                    return
+def main():
+    args = parse_args()
+    failed = split_dataset_and_upload_to_s3(args.csv, args.root_directory, args.bucket,
+                                            images_folder=args.images_folder, endpoint_url=args.endpoint_url,
+                                            workers=args.workers, use_links=not args.copy)
+    if failed:
+        sys.exit(1)
 
-        # Add a new line after the progress display is complete
-        print("\nUpload completed!")
-        print(f"Skipped {skipped_images} duplicate images.")
 
-    # Replace 'train' and 'val' with appropriate prefixes if desired
-    train_prefix = 'train'
-    val_prefix = 'val'
-
-    # Upload 'train' and 'val' folders to the S3 bucket
-    upload_to_s3(train_dir, train_prefix)
-    upload_to_s3(val_dir, val_prefix)
-
-# Usage:
-csv_file_path = 'styles.csv'  # Replace with the path to the CSV file
-root_directory = 'images'  # Replace with the root directory path
-s3_bucket_name = 'image-recommendation-dataset'  # Replace with your S3 bucket name
-split_dataset_and_upload_to_s3(csv_file_path, root_directory, s3_bucket_name)
+if __name__ == '__main__':
+    main()
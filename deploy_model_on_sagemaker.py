@@ -90,6 +90,7 @@ role = 'arn:aws:iam::483395534524:role/fashion_training_role'  # Replace with yo
 # )
 estimator = TensorFlow(
     entry_point='train.py',  # Your custom training script
+    dependencies=['image_store.py'],  # Shipped next to train.py for --data_format image_store
     role=role,
     instance_count=1,
     instance_type='ml.m4.xlarge',
@@ -0,0 +1,221 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from similarity_search import ExactSearchIndex, normalize_rows
+
+logger = logging.getLogger(__name__)
+
+PROJECTION_MANIFEST_KEY = 'projection'
+
+
+# PCA projection of L2-normalized embeddings down to `dim` dimensions, optionally whitened
+# (each component scaled to unit variance). Components are sorted by explained variance, so
+# a fitted projection can be truncated to any smaller dim without refitting.
+class PCAProjection:
+    def __init__(self, mean, components, explained_variance, whiten=False):
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+        self.whiten = whiten
+
+    @property
+    def dim(self):
+        return len(self.components)
+
+    @property
+    def source_dim(self):
+        return self.components.shape[1]
+
+    # Fit on at most max_samples rows, accumulating the covariance in blocks so a memory-mapped
+    # catalog is never read into memory at once
+    @classmethod
+    def fit(cls, embeddings, dim, whiten=False, max_samples=200000, block_size=16384, seed=0):
+        rows = np.arange(len(embeddings))
+        if len(rows) > max_samples:
+            rows = np.sort(np.random.default_rng(seed).choice(len(rows), max_samples, replace=False))
+        source_dim = embeddings.shape[1]
+        if dim > source_dim:
+            raise ValueError(f"Cannot project {source_dim}-dimensional embeddings up to {dim} dimensions")
+
+        total = np.zeros(source_dim, dtype=np.float64)
+        gram = np.zeros((source_dim, source_dim), dtype=np.float64)
+        for start in range(0, len(rows), block_size):
+            block = normalize_rows(embeddings[rows[start:start + block_size]], dtype=np.float64)
+            total += block.sum(axis=0)
+            gram += block.T @ block
+        mean = total / len(rows)
+        covariance = gram / len(rows) - np.outer(mean, mean)
+
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:dim]
+        return cls(mean.astype(np.float32), eigenvectors[:, order].T.astype(np.float32),
+                   np.clip(eigenvalues[order], 0, None).astype(np.float32), whiten)
+
+    def truncate(self, dim):
+        return PCAProjection(self.mean, self.components[:dim], self.explained_variance[:dim], self.whiten)
+
+    # Project raw model outputs: normalize like the catalog, center, rotate and (optionally) whiten
+    def transform(self, features, block_size=65536):
+        features = np.asarray(features).reshape(len(features), -1)
+        projected = np.empty((len(features), self.dim), dtype=np.float32)
+        scale = 1.0 / np.sqrt(self.explained_variance + 1e-8) if self.whiten else None
+        for start in range(0, len(features), block_size):
+            block = normalize_rows(features[start:start + block_size]) - self.mean
+            block = block @ self.components.T
+            projected[start:start + len(block)] = block * scale if self.whiten else block
+        return projected
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, mean=self.mean, components=self.components,
+                 explained_variance=self.explained_variance, whiten=np.array(self.whiten))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['mean'], data['components'], data['explained_variance'], bool(data['whiten']))
+
+
+# The projection an index bundle was built with, or None for a bundle of raw model embeddings
+def load_bundle_projection(bundle_path, manifest):
+    info = manifest.get(PROJECTION_MANIFEST_KEY)
+    if not info:
+        return None
+    return PCAProjection.load(os.path.join(bundle_path, info['file']))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Fit a PCA/whitening projection and write a compact index bundle')
+    parser.add_argument("--bundle", type=str, default="index_bundle")
+    parser.add_argument("--output", type=str, default="index_bundle_pca")
+    parser.add_argument("--dim", type=int, default=128)
+    parser.add_argument("--whiten", action="store_true")
+    parser.add_argument("--fit_samples", type=int, default=200000)
+    parser.add_argument("--report_dims", type=str, default="32,64,128,256",
+                        help="Comma separated dims whose retrieval quality is reported next to --dim")
+    parser.add_argument("--eval_queries", type=int, default=1000, help="Catalog rows used as queries in the report")
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--report", type=str, default="projection_report.json")
+    return parser.parse_args()
+
+
+def search_latency_ms(index, queries, top_k, runs=20):
+    index.search_batch(queries[:1], top_k)
+    timings = []
+    for i in range(runs):
+        started_at = time.perf_counter()
+        index.search_batch(queries[i % len(queries):i % len(queries) + 1], top_k)
+        timings.append(time.perf_counter() - started_at)
+    return float(np.median(timings) * 1000)
+
+
+# How well each projected dim preserves the full-dimensional neighbours of held-out catalog
+# rows (the query row itself excluded), next to the index size and single-query scan time
+def tradeoff_report(embeddings, projection, dims, num_queries, top_k, seed=0):
+    rng = np.random.default_rng(seed)
+    query_rows = np.sort(rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False))
+    queries = np.asarray(embeddings[query_rows], dtype=np.float32)
+
+    def neighbours(index, query_vectors):
+        found, _ = index.search_batch(query_vectors, top_k + 1)
+        return [[i for i in row if i != q][:top_k] for row, q in zip(found, query_rows)]
+
+    full_index = ExactSearchIndex(embeddings, normalized=True)
+    reference = neighbours(full_index, queries)
+    report = {'full': {
+        'dim': int(embeddings.shape[1]),
+        'index_bytes': int(len(embeddings) * embeddings.shape[1] * 4),
+        'search_latency_ms_p50': search_latency_ms(full_index, queries, top_k),
+    }}
+
+    # Rows are unit-length, so the total variance is 1 - |mean|^2
+    total_variance = 1.0 - float(projection.mean @ projection.mean)
+    for dim in sorted(d for d in dims if d <= projection.dim):
+        reduced = projection.truncate(dim)
+        projected_index = ExactSearchIndex(reduced.transform(embeddings))
+        found = neighbours(projected_index, reduced.transform(queries))
+        recall = [len(set(r) & set(f)) / top_k for r, f in zip(reference, found)]
+        report[str(dim)] = {
+            'dim': dim,
+            'whiten': projection.whiten,
+            f'recall_at_{top_k}_vs_full': float(np.mean(recall)),
+            'explained_variance_share': float(reduced.explained_variance.sum()) / max(total_variance, 1e-12),
+            'index_bytes': int(len(embeddings) * dim * 4),
+            'search_latency_ms_p50': search_latency_ms(projected_index, reduced.transform(queries), top_k),
+        }
+        logger.info(f"dim {dim}: {json.dumps(report[str(dim)])}")
+    return report
+
+
+# Write a new bundle holding the projected catalog and the projection itself. Rows keep their
+# order, so the attribute index is carried over; an IVF index must be retrained with
+# ann_index.py on the new bundle.
+def write_projected_bundle(bundle, projection, output):
+    from attribute_index import AttributeIndex, ATTRIBUTES_FILE
+    from catalog_segments import read_delta
+    from index_bundle import save_index_bundle
+
+    delta = read_delta(bundle.path, bundle.version)
+    if delta['ids'] or delta['removed_base_rows']:
+        raise ValueError("The bundle has pending delta changes; run 'catalog_segments.py compact' first")
+    if bundle.manifest.get(PROJECTION_MANIFEST_KEY):
+        raise ValueError("The bundle is already projected; project the original bundle instead")
+
+    os.makedirs(output, exist_ok=True)
+    projection_file = f'projection-{int(time.time() * 1000)}.npz'
+    projection.save(os.path.join(output, projection_file))
+    manifest = save_index_bundle(output, projection.transform(bundle.embeddings), bundle.filenames, ids=bundle.ids,
+                                 preprocessing=bundle.preprocessing, fingerprint=bundle.model_fingerprint,
+                                 extra={PROJECTION_MANIFEST_KEY: {
+                                     'file': projection_file, 'method': 'pca', 'dim': projection.dim,
+                                     'source_dim': projection.source_dim, 'whiten': projection.whiten,
+                                     'source_version': bundle.version,
+                                 }})
+    for stale in glob.glob(os.path.join(output, 'projection-*.npz')):
+        if os.path.basename(stale) != projection_file:
+            os.remove(stale)
+
+    attributes_path = os.path.join(bundle.path, ATTRIBUTES_FILE)
+    if os.path.exists(attributes_path):
+        attributes = AttributeIndex.load(attributes_path)
+        if attributes.source_version in (None, bundle.version):
+            attributes.source_version = manifest['index_version']
+            attributes.save(os.path.join(output, ATTRIBUTES_FILE))
+    return manifest
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    if os.path.abspath(args.output) == os.path.abspath(args.bundle):
+        raise SystemExit("--output must differ from --bundle; the original embeddings are needed to refit")
+
+    from index_bundle import load_index_bundle
+    bundle = load_index_bundle(args.bundle)
+    report_dims = sorted({int(d) for d in args.report_dims.split(',') if d} | {args.dim})
+    max_dim = min(max(report_dims), bundle.manifest['dim'])
+
+    logger.info(f"Fitting PCA ({'whitened' if args.whiten else 'unwhitened'}) on {len(bundle)} x "
+                f"{bundle.manifest['dim']} embeddings")
+    projection = PCAProjection.fit(bundle.embeddings, max_dim, whiten=args.whiten, max_samples=args.fit_samples)
+
+    report = tradeoff_report(bundle.embeddings, projection, report_dims, args.eval_queries, args.top_k)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote {args.report}")
+
+    manifest = write_projected_bundle(bundle, projection.truncate(args.dim), args.output)
+    logger.info(f"Wrote {manifest['count']} x {manifest['dim']} projected bundle to {args.output}; "
+                f"point FASHION_INDEX_DIR at it to serve it")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from functools import partial
+
+import numpy as np
+
+from catalog_segments import load_catalog_generation
+from similarity_search import SEARCH_BACKENDS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RELEVANCE = 'articleType,baseColour,masterCategory,articleType+baseColour'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Evaluate retrieval quality on the validation split')
+    parser.add_argument("--bundle", type=str, default="index_bundle", help="Catalog searched by the queries")
+    parser.add_argument("--backend", type=str, default="exact", choices=SEARCH_BACKENDS)
+    parser.add_argument("--nprobe", type=int, default=0)
+    parser.add_argument("--styles", type=str, default="styles.csv")
+    parser.add_argument("--val_dir", type=str, default="images/val",
+                        help="Validation split written by data_split.py; when missing, the split is recomputed")
+    parser.add_argument("--val_store", type=str, default=None, help="Validation images packed by image_store.py")
+    parser.add_argument("--model", type=str, default=None,
+                        help="Embed the queries with this artifact (.pkl Keras model or .tflite); by default the "
+                             "catalog's own vectors of the validation items are used as queries")
+    parser.add_argument("--relevance", type=str, default=DEFAULT_RELEVANCE,
+                        help="Comma separated label columns; 'a+b' requires both labels to match")
+    parser.add_argument("--ks", type=str, default="1,5,10,20")
+    parser.add_argument("--batch_size", type=int, default=4096, help="Queries per batched search")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", type=str, default="retrieval_report.json")
+    parser.add_argument("--baseline", type=str, default=None, help="Earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="Allowed absolute drop of any metric")
+    return parser.parse_args()
+
+
+# Validation ids, from the split directory if it exists, otherwise by repeating data_split.py's split
+def validation_ids(val_dir, val_store, styles):
+    if val_store:
+        from image_store import load_image_store
+        return list(load_image_store(val_store).ids)
+    if os.path.isdir(val_dir):
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(val_dir) if f.lower().endswith('.jpg'))
+    from sklearn.model_selection import train_test_split
+    logger.warning(f"No {val_dir}; recomputing the validation split like data_split.py")
+    _, val_df = train_test_split(styles, test_size=0.2, random_state=42)
+    return [str(i) for i in val_df['id']]
+
+
+def catalog_ids(generation):
+    return list(generation.bundle.ids) + list(generation.delta['ids'])
+
+
+# Normalized catalog vectors for the given rows of a generation (base rows, then delta rows)
+def catalog_vectors(generation, rows):
+    num_base = len(generation.bundle)
+    vectors = np.empty((len(rows), generation.search_index.dim), dtype=np.float32)
+    base = rows < num_base
+    vectors[base] = generation.bundle.embeddings[rows[base]]
+    vectors[~base] = generation.search_index.delta_embeddings[rows[~base] - num_base]
+    return vectors
+
+
+def _load_query_image(image_id, val_dir, target_size):
+    from image_preprocessing import load_and_resize
+    return load_and_resize(os.path.join(val_dir, f'{image_id}.jpg'), target_size)
+
+
+# Embed the validation images with a model artifact and map them into the catalog's space.
+# Returns the embeddings and the ids that could be read.
+def embed_queries(model_path, ids, val_dir, val_store, target_size, generation, workers, batch_size=256):
+    from image_preprocessing import preprocess_batch
+
+    if model_path.endswith('.tflite'):
+        from tflite_embedder import TFLiteEmbedder
+        embedder = TFLiteEmbedder(model_path)
+    else:
+        from keras_embedder import KerasEmbedder
+        embedder = KerasEmbedder(model_path)
+
+    if val_store:
+        from image_store import load_image_store
+        store = load_image_store(val_store)
+        images, kept = store.images, list(store.ids)
+    else:
+        load = partial(_load_query_image, val_dir=val_dir, target_size=target_size)
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            loaded = pool.map(load, ids, chunksize=64)
+        kept = [image_id for image_id, img in zip(ids, loaded) if img is not None]
+        images = np.stack([img for img in loaded if img is not None])
+
+    features = [embedder.predict(preprocess_batch(images[start:start + batch_size]))
+                for start in range(0, len(images), batch_size)]
+    features = np.vstack([f.reshape(len(f), -1) for f in features])
+    return generation.project(features), kept
+
+
+# Integer code per id for one relevance definition ('a+b' means both labels must match);
+# ids without all the labels are left out
+def label_code_map(styles, columns):
+    complete = styles[columns].notna().all(axis=1)
+    codes, _ = styles[columns][complete].astype(str).agg('|'.join, axis=1).factorize()
+    return dict(zip(styles['id'][complete].astype(str), codes))
+
+
+def label_codes(code_of_id, ids):
+    return np.array([code_of_id.get(i, -1) for i in ids], dtype=np.int64)
+
+
+# precision@k, recall@k and mAP@k for every query at once. `relevant` is the (queries x max_k)
+# boolean hit matrix in rank order; `total_relevant` the number of relevant catalog items per
+# query. Recall and mAP skip queries with nothing relevant to find.
+def retrieval_metrics(relevant, total_relevant, ks):
+    hits = np.cumsum(relevant, axis=1)
+    ranks = np.arange(1, relevant.shape[1] + 1)
+    precision_at_rank = hits / ranks
+    has_relevant = total_relevant > 0
+    metrics = {'queries': int(len(relevant)), 'queries_with_relevant_items': int(has_relevant.sum())}
+    for k in ks:
+        ap = (precision_at_rank[:, :k] * relevant[:, :k]).sum(axis=1)
+        ap = ap[has_relevant] / np.minimum(total_relevant[has_relevant], k)
+        metrics[f'precision_at_{k}'] = float(hits[:, k - 1].mean() / k)
+        metrics[f'recall_at_{k}'] = float((hits[has_relevant, k - 1] / total_relevant[has_relevant]).mean())
+        metrics[f'map_at_{k}'] = float(ap.mean())
+    return metrics
+
+
+def find_regressions(report, baseline, tolerance):
+    regressions = []
+    for relevance, metrics in baseline.get('metrics', {}).items():
+        for name, old in metrics.items():
+            new = report['metrics'].get(relevance, {}).get(name)
+            if name.startswith(('precision_at_', 'recall_at_', 'map_at_')) and new is not None and old - new > tolerance:
+                regressions.append({'relevance': relevance, 'metric': name, 'baseline': old, 'current': new})
+    return regressions
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    ks = sorted(int(k) for k in args.ks.split(',') if k)
+    max_k = ks[-1]
+
+    from attribute_index import load_styles
+    styles = load_styles(args.styles)
+    generation = load_catalog_generation(args.bundle, backend=args.backend, nprobe=args.nprobe or None)
+    ids = catalog_ids(generation)
+    row_of_id = {image_id: row for row, image_id in enumerate(ids)}
+    # Tombstoned base rows are never returned, so they cannot count as relevant either
+    alive = np.ones(len(ids), dtype=bool)
+    alive[:len(generation.search_index.removed)] = ~generation.search_index.removed
+
+    query_ids = validation_ids(args.val_dir, args.val_store, styles)
+    started_at = time.perf_counter()
+    if args.model:
+        target_size = tuple(generation.bundle.preprocessing['target_size'])
+        queries, query_ids = embed_queries(args.model, query_ids, args.val_dir, args.val_store, target_size,
+                                           generation, args.workers)
+    else:
+        # The catalog already holds a vector for every validation item; search with it directly
+        query_ids = [i for i in query_ids if i in row_of_id and alive[row_of_id[i]]]
+        queries = catalog_vectors(generation, np.array([row_of_id[i] for i in query_ids], dtype=np.int64))
+    embed_seconds = time.perf_counter() - started_at
+    if not query_ids:
+        raise SystemExit("No validation items to evaluate")
+    logger.info(f"Evaluating {len(query_ids)} queries against {len(generation)} catalog items")
+
+    # One extra result per query, so dropping the query's own catalog entry still leaves max_k
+    self_rows = np.array([row_of_id.get(i, -1) for i in query_ids], dtype=np.int64)
+    started_at = time.perf_counter()
+    indices = np.vstack([generation.search_index.search_batch(queries[start:start + args.batch_size], max_k + 1)[0]
+                         for start in range(0, len(queries), args.batch_size)])
+    search_seconds = time.perf_counter() - started_at
+    not_self = indices != self_rows[:, None]
+    order = np.argsort(~not_self, axis=1, kind='stable')[:, :max_k]
+    indices = np.take_along_axis(indices, order, axis=1)
+
+    report = {
+        'bundle': args.bundle,
+        'catalog_version': generation.version,
+        'backend': args.backend,
+        'nprobe': args.nprobe or None,
+        'model': args.model,
+        'queries': len(query_ids),
+        'catalog_size': len(generation),
+        'embed_seconds': embed_seconds,
+        'search_seconds': search_seconds,
+        'metrics': {},
+    }
+    for relevance in [r for r in args.relevance.split(',') if r]:
+        code_of_id = label_code_map(styles, relevance.split('+'))
+        catalog_codes = label_codes(code_of_id, ids)
+        catalog_codes[~alive] = -1
+        query_codes = label_codes(code_of_id, query_ids)
+
+        valid = indices >= 0
+        relevant = valid & (catalog_codes[np.clip(indices, 0, None)] == query_codes[:, None]) & (query_codes[:, None] >= 0)
+        counts = np.bincount(catalog_codes[catalog_codes >= 0], minlength=max(query_codes.max() + 1, 1))
+        total_relevant = np.where(query_codes >= 0, counts[np.clip(query_codes, 0, None)], 0)
+        # The query's own catalog entry is never among the results, so it does not count as findable
+        self_counted = (self_rows >= 0) & (query_codes >= 0)
+        self_counted[self_counted] &= catalog_codes[self_rows[self_counted]] == query_codes[self_counted]
+        total_relevant = total_relevant - self_counted
+
+        labelled = query_codes >= 0
+        report['metrics'][relevance] = retrieval_metrics(relevant[labelled], total_relevant[labelled], ks)
+        logger.info(f"{relevance}: {json.dumps(report['metrics'][relevance])}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = find_regressions(report, json.load(f), args.tolerance)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote {args.output}")
+
+    if report.get('regressions'):
+        for regression in report['regressions']:
+            logger.error(f"Regression in {regression['relevance']} {regression['metric']}: "
+                         f"{regression['baseline']:.4f} -> {regression['current']:.4f}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import joblib
+import numpy as np
+
+from build_index import list_catalog_images
+from image_preprocessing import load_and_resize, preprocess_batch
+from similarity_search import ExactSearchIndex
+from index_bundle import model_fingerprint
+from tflite_embedder import TFLiteEmbedder, write_artifact_info
+
+logger = logging.getLogger(__name__)
+
+QUANTIZATIONS = ('float32', 'float16', 'int8')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export model_80x80.pkl to TFLite and check parity')
+    parser.add_argument("--model", type=str, default="model_80x80.pkl")
+    parser.add_argument("--image_dir", type=str, default="images")
+    parser.add_argument("--output_dir", type=str, default=".")
+    parser.add_argument("--quantization", type=str, default="float32,float16,int8",
+                        help=f"Comma separated subset of {QUANTIZATIONS}")
+    parser.add_argument("--calibration_images", type=int, default=500)
+    parser.add_argument("--parity_images", type=int, default=500)
+    parser.add_argument("--bundle", type=str, default=None,
+                        help="Index bundle used as the catalog for the top-k overlap check")
+    parser.add_argument("--top_k", type=int, default=10)
+    parser.add_argument("--latency_runs", type=int, default=200)
+    parser.add_argument("--report", type=str, default="tflite_export_report.json")
+    return parser.parse_args()
+
+
+def current_rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def load_sample(image_dir, filenames):
+    images = [load_and_resize(os.path.join(image_dir, f)) for f in filenames]
+    return preprocess_batch(np.stack([img for img in images if img is not None]))
+
+
+def convert(model, quantization, calibration):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        # Full-integer kernels calibrated on catalog images; input and output stay float32
+        def representative_dataset():
+            for i in range(len(calibration)):
+                yield [calibration[i:i + 1]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    return converter.convert()
+
+
+# Median single-image latency in milliseconds, after one warm-up call
+def single_image_latency_ms(predict, sample, runs):
+    predict(sample[:1])
+    timings = []
+    for i in range(runs):
+        x = sample[i % len(sample):i % len(sample) + 1]
+        started_at = time.perf_counter()
+        predict(x)
+        timings.append(time.perf_counter() - started_at)
+    return float(np.median(timings) * 1000)
+
+
+# Cosine drift of the candidate embeddings from the reference ones, and how much of each
+# reference top-k list survives when the catalog is searched with the candidate embeddings.
+# A projected catalog (see embedding_projection.py) is searched with projected queries.
+def parity(reference, candidate, catalog, top_k, projection=None):
+    ref = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    cand = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    drift = 1.0 - (ref * cand).sum(axis=1)
+
+    if projection is not None:
+        reference, candidate = projection.transform(reference), projection.transform(candidate)
+    index = ExactSearchIndex(catalog)
+    ref_top, _ = index.search_batch(reference, top_k)
+    cand_top, _ = index.search_batch(candidate, top_k)
+    overlap = [len(set(r) & set(c)) / top_k for r, c in zip(ref_top, cand_top)]
+    return {
+        'cosine_drift_mean': float(drift.mean()),
+        'cosine_drift_p99': float(np.percentile(drift, 99)),
+        'cosine_drift_max': float(drift.max()),
+        f'top{top_k}_overlap_mean': float(np.mean(overlap)),
+        f'top{top_k}_overlap_min': float(np.min(overlap)),
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    quantizations = [q for q in args.quantization.split(',') if q]
+    for q in quantizations:
+        if q not in QUANTIZATIONS:
+            raise SystemExit(f"Unknown quantization: {q}. Choose from {QUANTIZATIONS}")
+
+    rss_before = current_rss_bytes()
+    started_at = time.perf_counter()
+    model = joblib.load(args.model)
+    keras_load_s = time.perf_counter() - started_at
+    keras_rss = current_rss_bytes() - rss_before
+
+    # Disjoint calibration and parity samples drawn from the catalog
+    filenames = list_catalog_images(args.image_dir)
+    rng = np.random.default_rng(0)
+    chosen = rng.permutation(len(filenames))[:args.calibration_images + args.parity_images]
+    calibration = load_sample(args.image_dir, [filenames[i] for i in chosen[:args.calibration_images]])
+    parity_sample = load_sample(args.image_dir, [filenames[i] for i in chosen[args.calibration_images:]])
+
+    reference = model.predict(parity_sample).reshape(len(parity_sample), -1)
+    projection = None
+    if args.bundle:
+        from embedding_projection import load_bundle_projection
+        from index_bundle import load_index_bundle
+        bundle = load_index_bundle(args.bundle)
+        catalog = bundle.embeddings
+        projection = load_bundle_projection(bundle.path, bundle.manifest)
+    else:
+        catalog = reference
+
+    report = {
+        'keras': {
+            'file_bytes': os.path.getsize(args.model),
+            'load_s': keras_load_s,
+            'load_rss_bytes': keras_rss,
+            'latency_ms_p50': single_image_latency_ms(model.predict, parity_sample, args.latency_runs),
+        },
+    }
+
+    base_name = os.path.splitext(os.path.basename(args.model))[0]
+    source_fingerprint = model_fingerprint(args.model)
+    for quantization in quantizations:
+        logger.info(f"Converting with {quantization} quantization")
+        output_path = os.path.join(args.output_dir, f'{base_name}_{quantization}.tflite')
+        with open(output_path, 'wb') as f:
+            f.write(convert(model, quantization, calibration))
+        write_artifact_info(output_path, {'source_model': os.path.basename(args.model),
+                                          'source_fingerprint': source_fingerprint, 'quantization': quantization})
+
+        rss_before = current_rss_bytes()
+        started_at = time.perf_counter()
+        embedder = TFLiteEmbedder(output_path)
+        embedder.predict(parity_sample[:1])
+        cold_start_s = time.perf_counter() - started_at
+        load_rss = current_rss_bytes() - rss_before
+
+        candidate = np.vstack([embedder.predict(parity_sample[i:i + 64]) for i in range(0, len(parity_sample), 64)])
+        report[quantization] = {
+            'path': output_path,
+            'file_bytes': os.path.getsize(output_path),
+            'load_and_first_inference_s': cold_start_s,
+            'load_rss_bytes': load_rss,
+            'latency_ms_p50': single_image_latency_ms(embedder.predict, parity_sample, args.latency_runs),
+            **parity(reference, candidate.reshape(len(candidate), -1), catalog, args.top_k, projection),
+        }
+        logger.info(f"{quantization}: {json.dumps(report[quantization])}")
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Wrote {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import cv2
+import numpy as np
+
+TARGET_SIZE = (80, 80)
+PREPROCESS_MODES = ('mobilenet', 'rescale')
+
+
+# Read an image from disk and resize it to the model input size.
+# Returns None if the file is missing or cannot be decoded.
+def load_and_resize(image_path, target_size=TARGET_SIZE):
+    img = cv2.imread(image_path)
+    if img is None:
+        return None
+    return cv2.resize(img, tuple(target_size))
+
+
+# Decode encoded image bytes (e.g. an upload) in memory. Returns None if the bytes are not
+# a decodable image.
+def decode_image(data):
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def resize_image(img, target_size=TARGET_SIZE):
+    return cv2.resize(img, tuple(target_size))
+
+
+# Scale a uint8 batch of shape (N, H, W, 3) to [-1, 1], the same transform as
+# tf.keras.applications.mobilenet.preprocess_input, without importing TensorFlow.
+def preprocess_batch(images):
+    return np.asarray(images, dtype=np.float32) / 127.5 - 1.0
+
+
+# Scale a uint8 batch by the 'preprocess_input' mode recorded in an index bundle's preprocessing:
+# 'mobilenet' to [-1, 1] (the embedding model app.py serves), 'rescale' to [0, 1] like the
+# ImageDataGenerator(rescale=1/255) train.py trains with
+def scale_batch(images, mode):
+    if mode == 'mobilenet':
+        return preprocess_batch(images)
+    if mode == 'rescale':
+        return np.asarray(images, dtype=np.float32) / 255.0
+    raise ValueError(f"Unknown preprocess_input mode: {mode}. Choose one of {PREPROCESS_MODES}")
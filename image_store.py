@@ -0,0 +1,153 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from functools import partial
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+IMAGES_FILE = 'images.npy'
+INDEX_FILE = 'index.json'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack catalog images, pre-resized, into one memory-mappable array')
+    parser.add_argument("--image_dir", type=str, default="images")
+    parser.add_argument("--output", type=str, default="image_store")
+    parser.add_argument("--target_size", type=str, default="[80, 80]")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--styles", type=str, default=None,
+                        help="styles.csv; with --label_column, stores a label per image for training")
+    parser.add_argument("--label_column", type=str, default=None)
+    return parser.parse_args()
+
+
+# A packed image store: images.npy holds every image as uint8 (N, H, W, 3), already resized to
+# the model input size, in the BGR channel order cv2 and the serving path use; index.json maps
+# rows to filenames and ids, and optionally to class labels. Opened memory-mapped, so readers
+# share the page cache and a full pass is one sequential read.
+class ImageStore:
+    def __init__(self, path, images, index):
+        self.path = path
+        self.images = images
+        self.index = index
+        self._row_of = {name: i for i, name in enumerate(self.filenames)}
+
+    def __len__(self):
+        return len(self.images)
+
+    @property
+    def filenames(self):
+        return self.index['filenames']
+
+    @property
+    def ids(self):
+        return self.index['ids']
+
+    @property
+    def labels(self):
+        return self.index.get('labels')
+
+    @property
+    def target_size(self):
+        return tuple(self.index['target_size'])
+
+    def row_of(self, filename):
+        return self._row_of.get(filename)
+
+    # The image for a filename, or None if it is not in the store
+    def get(self, filename):
+        row = self.row_of(filename)
+        return None if row is None else self.images[row]
+
+
+def load_image_store(path, mmap=True):
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        index = json.load(f)
+    if index.get('format_version') != STORE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported image store format: {index.get('format_version')}")
+    images = np.load(os.path.join(path, IMAGES_FILE), mmap_mode='r' if mmap else None)
+    # Rows past num_rows were reserved for images that turned out to be unreadable
+    return ImageStore(path, images[:index['num_rows']], index)
+
+
+def _load_image(filename, image_dir, target_size):
+    from image_preprocessing import load_and_resize
+    return load_and_resize(os.path.join(image_dir, filename), target_size)
+
+
+# Decode and resize every image with a process pool and write them, in filename order, into a
+# new store. The store is written next to the output and renamed into place when complete.
+def pack_images(filenames, image_dir, output, target_size, workers=None, labels=None):
+    tmp_output = output + '.tmp'
+    shutil.rmtree(tmp_output, ignore_errors=True)
+    os.makedirs(tmp_output)
+    height, width = target_size[1], target_size[0]
+    images = np.lib.format.open_memmap(os.path.join(tmp_output, IMAGES_FILE), mode='w+', dtype=np.uint8,
+                                       shape=(len(filenames), height, width, 3))
+
+    load = partial(_load_image, image_dir=image_dir, target_size=tuple(target_size))
+    kept = []
+    started_at = time.time()
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for i, img in enumerate(pool.imap(load, filenames, chunksize=64)):
+            if img is None:
+                logger.warning(f"Could not read image: {filenames[i]}")
+            else:
+                images[len(kept)] = img
+                kept.append(i)
+            if (i + 1) % 1000 == 0 or i + 1 == len(filenames):
+                sys.stdout.write(f"\rPacked {i + 1}/{len(filenames)} "
+                                 f"({(i + 1) / (time.time() - started_at):.1f} images/s)")
+                sys.stdout.flush()
+    print()
+    images.flush()
+    del images
+
+    index = {
+        'format_version': STORE_FORMAT_VERSION,
+        'num_rows': len(kept),
+        'target_size': list(target_size),
+        'color': 'bgr',
+        'filenames': [filenames[i] for i in kept],
+        'ids': [os.path.splitext(filenames[i])[0] for i in kept],
+    }
+    if labels is not None:
+        index['labels'] = [labels[i] for i in kept]
+    with open(os.path.join(tmp_output, INDEX_FILE), 'w') as f:
+        json.dump(index, f)
+
+    shutil.rmtree(output, ignore_errors=True)
+    os.replace(tmp_output, output)
+    logger.info(f"Packed {len(kept)} images into {output}; skipped {len(filenames) - len(kept)} unreadable images")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    from build_index import list_catalog_images
+    filenames = list_catalog_images(args.image_dir)
+    labels = None
+    if args.label_column:
+        import pandas as pd
+        styles = pd.read_csv(args.styles or 'styles.csv', usecols=['id', args.label_column], on_bad_lines='skip').dropna()
+        label_of_id = dict(zip(styles['id'].astype(str), styles[args.label_column].astype(str)))
+        filenames = [f for f in filenames if os.path.splitext(f)[0] in label_of_id]
+        labels = [label_of_id[os.path.splitext(f)[0]] for f in filenames]
+    if not filenames:
+        print(f"No images found in {args.image_dir}")
+        return
+
+    pack_images(filenames, args.image_dir, args.output, json.loads(args.target_size), args.workers, labels)
+
+
+if __name__ == '__main__':
+    main()
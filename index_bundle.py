@@ -0,0 +1,179 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from similarity_search import normalize_rows
+
+logger = logging.getLogger(__name__)
+
+BUNDLE_FORMAT_VERSION = 1
+EMBEDDINGS_FILE = 'embeddings.npy'
+MANIFEST_FILE = 'manifest.json'
+SUPPORTED_DTYPES = ('float32', 'float16')
+
+# Preprocessing used by extract_image_features in app.py
+DEFAULT_PREPROCESSING = {'target_size': [80, 80], 'color': 'bgr', 'preprocess_input': 'mobilenet'}
+
+
+# SHA-256 of the serialized model so an index can be matched to the model that produced it
+def model_fingerprint(model_path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(model_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Content hash of the bundle plus the save time, so every saved generation gets a new version
+# even when a rebuild produces identical content
+def _index_version(embeddings, filenames):
+    digest = hashlib.sha256(str(time.time_ns()).encode('ascii'))
+    for start in range(0, embeddings.shape[0], 65536):
+        digest.update(np.ascontiguousarray(embeddings[start:start + 65536]).tobytes())
+    digest.update('\n'.join(filenames).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def _image_id(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+class IndexBundle:
+    def __init__(self, path, embeddings, manifest):
+        self.path = path
+        self.embeddings = embeddings
+        self.manifest = manifest
+        self.filenames = manifest['filenames']
+        self.ids = manifest['ids']
+
+    def __len__(self):
+        return len(self.filenames)
+
+    @property
+    def version(self):
+        return self.manifest['index_version']
+
+    @property
+    def model_fingerprint(self):
+        return self.manifest.get('model_fingerprint')
+
+    @property
+    def preprocessing(self):
+        return self.manifest.get('preprocessing', DEFAULT_PREPROCESSING)
+
+
+def write_manifest(path, manifest):
+    tmp_path = os.path.join(path, MANIFEST_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, os.path.join(path, MANIFEST_FILE))
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Unsupported index bundle format: {manifest.get('format_version')}")
+    return manifest
+
+
+# Write a bundle directory holding the L2-normalized embedding matrix and its manifest.
+# Each generation's matrix gets its own file and the manifest is swapped in last, so readers
+# always see a complete bundle; processes still mapping an older matrix keep their mapping
+# when its file is removed.
+def save_index_bundle(path, embeddings, filenames, ids=None, model_path=None, preprocessing=None,
+                      dtype='float32', extra=None, fingerprint=None, normalized=False):
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"Unsupported dtype: {dtype}. Choose one of {SUPPORTED_DTYPES}")
+    if len(filenames) != len(embeddings):
+        raise ValueError(f"Got {len(filenames)} filenames for {len(embeddings)} embeddings")
+
+    os.makedirs(path, exist_ok=True)
+    filenames = [os.path.basename(f) for f in filenames]
+    ids = [str(i) for i in ids] if ids is not None else [_image_id(f) for f in filenames]
+    # Already-normalized input of the right dtype (e.g. a large memory-mapped matrix) is written
+    # through as-is instead of being copied into memory
+    if not (normalized and embeddings.dtype == np.dtype(dtype)):
+        embeddings = normalize_rows(embeddings).astype(dtype)
+    index_version = _index_version(embeddings, filenames)
+    embeddings_file = f'embeddings-{index_version}.npy'
+
+    tmp_embeddings = os.path.join(path, embeddings_file + '.tmp')
+    with open(tmp_embeddings, 'wb') as f:
+        np.save(f, embeddings)
+    os.replace(tmp_embeddings, os.path.join(path, embeddings_file))
+
+    manifest = {
+        'format_version': BUNDLE_FORMAT_VERSION,
+        'index_version': index_version,
+        'embeddings_file': embeddings_file,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'dtype': dtype,
+        'count': int(embeddings.shape[0]),
+        'dim': int(embeddings.shape[1]),
+        'normalized': True,
+        'model_fingerprint': model_fingerprint(model_path) if model_path else fingerprint,
+        'preprocessing': preprocessing or DEFAULT_PREPROCESSING,
+        'ids': ids,
+        'filenames': filenames,
+    }
+    if extra:
+        manifest.update(extra)
+    write_manifest(path, manifest)
+
+    for stale in glob.glob(os.path.join(path, 'embeddings*.npy')):
+        if os.path.basename(stale) != embeddings_file:
+            os.remove(stale)
+    logger.info(f"Saved index bundle {manifest['index_version']} with {manifest['count']} rows to {path}")
+    return manifest
+
+
+# Open a bundle. With mmap=True the embeddings are memory-mapped read-only, so startup does
+# not read the matrix and several worker processes share the same page-cached copy.
+def load_index_bundle(path, mmap=True):
+    manifest = read_manifest(path)
+    embeddings_file = manifest.get('embeddings_file', EMBEDDINGS_FILE)
+    embeddings = np.load(os.path.join(path, embeddings_file), mmap_mode='r' if mmap else None)
+    if embeddings.shape != (manifest['count'], manifest['dim']):
+        raise ValueError(f"Embeddings shape {embeddings.shape} does not match manifest "
+                         f"({manifest['count']}, {manifest['dim']})")
+    return IndexBundle(path, embeddings, manifest)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert a raw feature .npy file into an index bundle')
+    parser.add_argument("--features", type=str, default="raw_features_MainDataset_80x80.npy")
+    parser.add_argument("--image_dir", type=str, default="images")
+    parser.add_argument("--filenames", type=str, default=None,
+                        help="Text file with one image filename per feature row, in row order")
+    parser.add_argument("--model", type=str, default="model_80x80.pkl")
+    parser.add_argument("--output", type=str, default="index_bundle")
+    parser.add_argument("--dtype", type=str, default="float32", choices=SUPPORTED_DTYPES)
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    features = np.load(args.features)
+    if args.filenames:
+        with open(args.filenames) as f:
+            filenames = [line.strip() for line in f if line.strip()]
+    else:
+        # Same listing the server used to map rows to files before bundles existed
+        logger.warning("No --filenames given; assuming feature rows follow the image directory listing order")
+        filenames = glob.glob(os.path.join(args.image_dir, '*.jpg'))
+
+    model_path = args.model if os.path.exists(args.model) else None
+    save_index_bundle(args.output, features, filenames, model_path=model_path, dtype=args.dtype)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,202 @@
+import argparse
+import io
 import json
+import os
 import numpy as np
 import tensorflow as tf
 
-# The 'model_fn' is required to load the model when the SageMaker endpoint starts
+from image_preprocessing import decode_image, resize_image, scale_batch
+
+# Optional in-endpoint catalog search: when an index bundle is found (FASHION_ENDPOINT_INDEX, or
+# an 'index_bundle' directory inside the model directory), predictions are top-k catalog ids
+# instead of raw embeddings
+ENDPOINT_INDEX = os.environ.get('FASHION_ENDPOINT_INDEX')
+ENDPOINT_TOP_K = int(os.environ.get('FASHION_ENDPOINT_TOP_K', 5))
+ENDPOINT_MAX_BATCH = int(os.environ.get('FASHION_ENDPOINT_MAX_BATCH', 64))
+SEARCH_BACKEND = os.environ.get('FASHION_SEARCH_BACKEND', 'exact')
+
+# How raw pixels are turned into model input. By default this follows the loaded catalog's
+# 'preprocessing' manifest entry; without a catalog, a .pkl embedding model gets app.py's
+# mobilenet/BGR preprocessing and a train.py SavedModel its rescale=1/255 RGB input. Either
+# can be forced with FASHION_ENDPOINT_PREPROCESS_INPUT (mobilenet|rescale) and
+# FASHION_ENDPOINT_COLOR (bgr|rgb). The input size always comes from the model (or catalog).
+ENDPOINT_PREPROCESS_INPUT = os.environ.get('FASHION_ENDPOINT_PREPROCESS_INPUT')
+ENDPOINT_COLOR = os.environ.get('FASHION_ENDPOINT_COLOR')
+
+NPY_CONTENT_TYPE = 'application/x-npy'
+JSONLINES_CONTENT_TYPES = ('application/jsonlines', 'application/x-jsonlines')
+IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/png')
+
+
+# What model_fn hands to predict_fn: the Keras model, how to preprocess its input and,
+# optionally, the catalog to search
+class EndpointModel:
+    def __init__(self, model, catalog=None, top_k=ENDPOINT_TOP_K, preprocessing=None):
+        self.model = model
+        self.catalog = catalog
+        self.top_k = top_k
+        self.preprocessing = preprocessing or default_preprocessing(model, catalog)
+
+    # uint8 RGB pixels (N, H, W, 3) -> model input: resize, channel order, scaling
+    def prepare(self, images):
+        width, height = self.preprocessing['target_size']
+        if images.shape[1:3] != (height, width):
+            images = np.stack([resize_image(img, (width, height)) for img in images])
+        if self.preprocessing['color'] == 'bgr':
+            images = images[..., ::-1]
+        x = scale_batch(images, self.preprocessing['preprocess_input'])
+        if self.preprocessing.get('channels') == 1:
+            x = (x @ np.array([0.2989, 0.587, 0.114], dtype=np.float32))[..., np.newaxis]
+        return x
+
+
+def _model_input_shape(model):
+    shape = getattr(model, 'input_shape', None)
+    if not shape or None in shape[1:]:
+        return None
+    return tuple(int(d) for d in shape[1:])
+
+
+# The preprocessing for a served model: the catalog's manifest entry when a catalog is loaded,
+# otherwise derived from the model (see ENDPOINT_PREPROCESS_INPUT above)
+def default_preprocessing(model, catalog=None, saved_model=False):
+    input_shape = _model_input_shape(model)
+    if catalog is not None:
+        preprocessing = dict(catalog.bundle.preprocessing)
+    else:
+        if input_shape is None:
+            raise ValueError("The model has no fixed input shape; serve it with a catalog to know its input size")
+        preprocessing = {'target_size': [input_shape[1], input_shape[0]],
+                         'color': 'rgb' if saved_model else 'bgr',
+                         'preprocess_input': 'rescale' if saved_model else 'mobilenet'}
+    if ENDPOINT_PREPROCESS_INPUT:
+        preprocessing['preprocess_input'] = ENDPOINT_PREPROCESS_INPUT
+    if ENDPOINT_COLOR:
+        preprocessing['color'] = ENDPOINT_COLOR
+    if input_shape is not None:
+        preprocessing['channels'] = input_shape[2]
+    return preprocessing
+
+
+def _load_catalog(model_dir):
+    index_path = ENDPOINT_INDEX or os.path.join(model_dir, 'index_bundle')
+    if not os.path.isdir(index_path):
+        return None
+    from catalog_segments import load_catalog_generation
+    return load_catalog_generation(index_path, backend=SEARCH_BACKEND)
+
+
+# The 'model_fn' is required to load the model when the SageMaker endpoint starts.
+# A .pkl path (like model_80x80.pkl) is loaded with joblib, for running the handler locally.
 def model_fn(model_dir):
-    model = tf.keras.models.load_model(model_dir)
-    return model
+    model_dir_is_pickle = model_dir.endswith('.pkl')
+    if model_dir_is_pickle:
+        import joblib
+        model = joblib.load(model_dir)
+        model_dir = os.path.dirname(os.path.abspath(model_dir))
+    else:
+        model = tf.keras.models.load_model(model_dir)
+    catalog = _load_catalog(model_dir)
+    preprocessing = default_preprocessing(model, catalog, saved_model=not model_dir_is_pickle)
+    return EndpointModel(model, catalog, preprocessing=preprocessing)
+
 
-# The 'input_fn' is used to deserialize the JSON input data into a NumPy array
+# The 'input_fn' deserializes the request into a batch array. JSON and JSON Lines (one instance
+# per line, as batch transform sends with SplitType=Line) and .npy bodies may hold a single
+# instance or a batch. JPEG/PNG bodies are decoded to RGB pixels. uint8 arrays are treated as
+# raw RGB pixels and resized and preprocessed for the served model in predict_fn; float arrays
+# are passed to the model as they are.
 def input_fn(request_body, content_type='application/json'):
+    content_type = content_type.split(';')[0].strip()
     if content_type == 'application/json':
-        data = json.loads(request_body)
-        return np.array(data)
+        data = np.array(json.loads(request_body))
+    elif content_type in JSONLINES_CONTENT_TYPES:
+        if isinstance(request_body, bytes):
+            request_body = request_body.decode('utf-8')
+        data = np.stack([np.array(json.loads(line)) for line in request_body.splitlines() if line.strip()])
+    elif content_type == NPY_CONTENT_TYPE:
+        data = np.load(io.BytesIO(request_body), allow_pickle=False)
+    elif content_type in IMAGE_CONTENT_TYPES:
+        img = decode_image(request_body)
+        if img is None:
+            raise ValueError("Request body is not a decodable image")
+        data = np.ascontiguousarray(img[np.newaxis, ..., ::-1])
     else:
         raise ValueError(f"Unsupported content type: {content_type}")
 
-# The 'predict_fn' is used to perform inference using the loaded model
+    # A single (H, W, C) instance becomes a batch of one
+    if data.ndim == 3:
+        data = data[np.newaxis]
+    return data
+
+
+# The 'predict_fn' is used to perform inference using the loaded model. Large batches are run
+# in chunks to bound memory. With a catalog loaded, returns the top-k catalog ids and scores.
 def predict_fn(input_data, model):
-    predictions = model.predict(input_data)
-    return predictions
+    if not isinstance(model, EndpointModel):
+        model = EndpointModel(model)
+    if input_data.dtype == np.uint8:
+        input_data = model.prepare(input_data)
+
+    chunks = [input_data[start:start + ENDPOINT_MAX_BATCH] for start in range(0, len(input_data), ENDPOINT_MAX_BATCH)]
+    predictions = np.vstack([model.model.predict(chunk).reshape(len(chunk), -1) for chunk in chunks])
+    if model.catalog is None:
+        return predictions
+
+    indices, scores = model.catalog.search_index.search_batch(model.catalog.project(predictions), top_k=model.top_k)
+    filenames = model.catalog.filenames
+    return [
+        [{'id': os.path.splitext(filenames[idx])[0], 'score': float(score)}
+         for idx, score in zip(row_indices, row_scores) if idx >= 0]
+        for row_indices, row_scores in zip(indices, scores)
+    ]
+
 
-# The 'output_fn' is used to serialize the predictions into JSON format
+# The 'output_fn' serializes the predictions: JSON, JSON Lines (one line per input, for batch
+# transform) or .npy. Top-k results are returned as an (N, k) array of ids when .npy is asked for.
 def output_fn(predictions, content_type='application/json'):
+    content_type = content_type.split(';')[0].strip()
+    is_array = isinstance(predictions, np.ndarray)
     if content_type == 'application/json':
-        return json.dumps(predictions.tolist())
+        return json.dumps(predictions.tolist() if is_array else predictions)
+    elif content_type in JSONLINES_CONTENT_TYPES:
+        rows = predictions.tolist() if is_array else predictions
+        return '\n'.join(json.dumps(row) for row in rows) + '\n'
+    elif content_type == NPY_CONTENT_TYPE:
+        if not is_array:
+            predictions = np.array([[match['id'] for match in row] for row in predictions], dtype=str)
+        buffer = io.BytesIO()
+        np.save(buffer, predictions, allow_pickle=False)
+        return buffer.getvalue()
     else:
         raise ValueError(f"Unsupported content type: {content_type}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the SageMaker handlers locally on one request body')
+    parser.add_argument("--model_dir", type=str, default="model_80x80.pkl")
+    parser.add_argument("--input", type=str, required=True, help="File holding the request body")
+    parser.add_argument("--content_type", type=str, default="image/jpeg")
+    parser.add_argument("--accept", type=str, default="application/json")
+    parser.add_argument("--output", type=str, default=None, help="Write the response body here instead of stdout")
+    return parser.parse_args()
+
+
+# Exercise model_fn -> input_fn -> predict_fn -> output_fn the way the endpoint does, without AWS
+def main():
+    args = parse_args()
+    model = model_fn(args.model_dir)
+    with open(args.input, 'rb') as f:
+        body = f.read()
+    response = output_fn(predict_fn(input_fn(body, args.content_type), model), args.accept)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(response if isinstance(response, bytes) else response.encode('utf-8'))
+    elif isinstance(response, bytes):
+        print(f"{len(response)} bytes of {args.accept}")
+    else:
+        print(response)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,25 @@
+import numpy as np
+
+
+# Runs the pickled Keras embedding model through a tf.function traced once for a fixed input
+# signature (any batch size, the model's own image shape), with the same predict(x) interface
+# as TFLiteEmbedder. Model.predict rebuilds its input pipeline on every call and retraces for
+# new batch sizes; a direct call into the traced graph avoids both on the request path.
+class KerasEmbedder:
+    def __init__(self, model_path):
+        import joblib
+        import tensorflow as tf
+
+        self.model_path = model_path
+        self.model = joblib.load(model_path)
+        model = self.model
+        self._predict = tf.function(lambda x: model(x, training=False),
+                                    input_signature=[tf.TensorSpec([None, *self.input_shape], tf.float32)])
+
+    @property
+    def input_shape(self):
+        return tuple(int(d) for d in self.model.input_shape[1:])
+
+    # x is a preprocessed float batch of shape (N, H, W, 3)
+    def predict(self, x):
+        return self._predict(np.asarray(x, dtype=np.float32)).numpy()
@@ -0,0 +1,112 @@
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+CLASSES_FILE = 'classes.json'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert the train/val splits into sharded, pre-resized TFRecords')
+    parser.add_argument("--root_directory", type=str, default="images",
+                        help="Directory holding the 'train' and 'val' splits made by data_split.py")
+    parser.add_argument("--output_dir", type=str, default="tfrecords")
+    parser.add_argument("--styles", type=str, default="styles.csv",
+                        help="Used for labels when a split directory has no class sub-folders")
+    parser.add_argument("--label_column", type=str, default="masterCategory")
+    parser.add_argument("--image_size", type=str, default="[80, 80]")
+    parser.add_argument("--num_shards", type=int, default=16, help="Shards per split")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    return parser.parse_args()
+
+
+# (path, class name) for every image in a split. Class sub-folders are used the way
+# flow_from_directory uses them; a flat split (as written by data_split.py) takes its labels
+# from styles.csv by image id.
+def list_examples(split_dir, styles_path, label_column):
+    class_dirs = sorted(d for d in os.listdir(split_dir) if os.path.isdir(os.path.join(split_dir, d)))
+    if class_dirs:
+        return [(path, class_name) for class_name in class_dirs
+                for path in sorted(glob.glob(os.path.join(split_dir, class_name, '*.jpg')))]
+
+    import pandas as pd
+    styles = pd.read_csv(styles_path, usecols=['id', label_column], on_bad_lines='skip').dropna()
+    label_of_id = dict(zip(styles['id'].astype(str), styles[label_column].astype(str)))
+    examples = []
+    for path in sorted(glob.glob(os.path.join(split_dir, '*.jpg'))):
+        label = label_of_id.get(os.path.splitext(os.path.basename(path))[0])
+        if label is not None:
+            examples.append((path, label))
+    return examples
+
+
+# Write one shard. Images are stored already resized as raw RGB uint8 bytes, so training only
+# has to reinterpret the bytes instead of decoding a JPEG every epoch. Resizing uses nearest
+# neighbour, the ImageDataGenerator default, so the records match what train.py saw before.
+def write_shard(job):
+    import tensorflow as tf
+
+    shard_path, examples, image_size = job
+    written = 0
+    with tf.io.TFRecordWriter(shard_path) as writer:
+        for path, label in examples:
+            img = cv2.imread(path)
+            if img is None:
+                continue
+            img = cv2.cvtColor(cv2.resize(img, (image_size[1], image_size[0]), interpolation=cv2.INTER_NEAREST),
+                               cv2.COLOR_BGR2RGB)
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img.tobytes()])),
+                'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[label])),
+                'height': tf.train.Feature(int64_list=tf.train.Int64List(value=[image_size[0]])),
+                'width': tf.train.Feature(int64_list=tf.train.Int64List(value=[image_size[1]])),
+            }))
+            writer.write(example.SerializeToString())
+            written += 1
+    return written
+
+
+def main():
+    args = parse_args()
+    image_size = json.loads(args.image_size)
+
+    splits = {split: list_examples(os.path.join(args.root_directory, split), args.styles, args.label_column)
+              for split in ('train', 'val')}
+    # Class indices come from the training split, in sorted order like flow_from_directory
+    classes = sorted({label for _, label in splits['train']})
+    class_index = {name: i for i, name in enumerate(classes)}
+
+    rng = np.random.default_rng(42)
+    with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+        for split, examples in splits.items():
+            split_dir = os.path.join(args.output_dir, split)
+            os.makedirs(split_dir, exist_ok=True)
+            # Each split carries the class list, since training mounts the splits separately
+            with open(os.path.join(split_dir, CLASSES_FILE), 'w') as f:
+                json.dump({'classes': classes, 'image_size': image_size}, f)
+            examples = [(path, class_index[label]) for path, label in examples if label in class_index]
+            # Shuffle before sharding so every shard holds a mix of classes
+            examples = [examples[i] for i in rng.permutation(len(examples))]
+            num_shards = max(1, min(args.num_shards, len(examples)))
+            jobs = [(os.path.join(split_dir, f'{split}-{i:05d}-of-{num_shards:05d}.tfrecord'),
+                     examples[i::num_shards], image_size) for i in range(num_shards)]
+
+            started_at = time.time()
+            written = 0
+            for count in pool.imap_unordered(write_shard, jobs):
+                written += count
+                sys.stdout.write(f"\r{split}: {written}/{len(examples)} examples")
+                sys.stdout.flush()
+            elapsed = time.time() - started_at
+            print(f"\n{split}: wrote {written} examples in {num_shards} shards "
+                  f"({written / max(elapsed, 1e-9):.1f} examples/s)")
+
+
+if __name__ == '__main__':
+    main()
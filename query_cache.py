@@ -0,0 +1,90 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+# Content hash of the raw uploaded bytes
+def bytes_key(data):
+    return 'b:' + hashlib.sha256(data).hexdigest()
+
+
+# Content hash of a decoded, resized image, so differently encoded copies of the same
+# picture (re-saved JPEGs, PNG vs JPEG) still share an entry
+def pixels_key(img):
+    return f'p:{img.shape}:' + hashlib.sha256(img.tobytes()).hexdigest()
+
+
+# Thread-safe LRU cache with a per-entry TTL for query embeddings and top-k results.
+# Every key is scoped to a version string (index version + model fingerprint); changing the
+# version drops all entries so results from an old index or model are never served.
+class QueryCache:
+    def __init__(self, max_entries=10000, ttl_seconds=3600, version=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.version = version
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def set_version(self, version):
+        with self._lock:
+            if version != self.version:
+                self.version = version
+                self._entries.clear()
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Store value under each key. version guards against a result computed before a
+    # version change being written into the cache after it.
+    def put(self, keys, value, version=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            if version is not None and version != self.version:
+                return
+            expires_at = time.monotonic() + self.ttl_seconds
+            for key in keys:
+                self._entries[key] = (expires_at, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'version': self.version,
+            }
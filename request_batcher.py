@@ -0,0 +1,71 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+# Collects items submitted concurrently by request threads and hands them to process_batch
+# as one list. A batch is dispatched as soon as it holds max_batch_size items, or max_wait_ms
+# after its first item arrived, whichever comes first, so a lone request under light load
+# waits at most max_wait_ms. process_batch must return one result per item, in order.
+# With max_queue_size set, submitting to a full queue raises QueueFullError instead of letting
+# the backlog (and every caller's latency) grow without bound.
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=5.0, max_queue_size=0, name='micro-batcher'):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    # Queue an item and return a Future for its result
+    def submit_async(self, item):
+        future = Future()
+        try:
+            self._queue.put_nowait((item, future))
+        except queue.Full:
+            raise QueueFullError(f"Inference queue is full ({self._queue.maxsize} pending items)")
+        return future
+
+    # Number of items waiting for a batch
+    def pending(self):
+        return self._queue.qsize()
+
+    # Queue an item and block until its batch has been processed
+    def submit(self, item, timeout=None):
+        return self.submit_async(item).result(timeout=timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"Batch of {len(items)} items returned {len(results)} results")
+            except Exception as e:
+                logger.exception('Error processing batch')
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,97 @@
+import argparse
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description='Run the recommendation API with prefork workers')
+    parser.add_argument("--bind", type=str, default="0.0.0.0:5000")
+    parser.add_argument("--tf_threads", type=int, default=4, help="TensorFlow intra-op threads per worker")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Worker processes; defaults to the core count divided by --tf_threads")
+    parser.add_argument("--threads", type=int, default=32,
+                        help="Request threads per worker; concurrent requests are micro-batched")
+    parser.add_argument("--max_queue", type=int, default=256,
+                        help="Per-worker inference queue bound; requests beyond it get 503")
+    parser.add_argument("--pin_cpus", action="store_true", help="Pin each worker to its own block of cores")
+    parser.add_argument("--timeout", type=int, default=60)
+    args = parser.parse_args()
+    args.workers = args.workers or max(1, cpu_count // args.tf_threads)
+    return args
+
+
+# Split TensorFlow's thread pools for this process. Must run before TensorFlow executes any op,
+# i.e. in the worker before app.py is imported. The TFLite runtime takes its thread count from
+# FASHION_TFLITE_THREADS instead, and TensorFlow itself is then never imported.
+def configure_tensorflow_threads(intra_op_threads, inter_op_threads=1):
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(intra_op_threads)
+    if os.environ.get('FASHION_MODEL_RUNTIME') == 'tflite':
+        os.environ.setdefault('FASHION_TFLITE_THREADS', str(intra_op_threads))
+        return
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise SystemExit("serve.py needs gunicorn: pip install gunicorn")
+
+    cpu_count = os.cpu_count() or 1
+    os.environ['FASHION_MAX_QUEUE'] = str(args.max_queue)
+
+    # The app is not preloaded: TensorFlow's thread pools must not be created before the fork.
+    # Each worker imports app.py itself; the index bundle is memory-mapped, so all workers share
+    # one page-cached copy of the embeddings rather than holding private copies.
+    # With --pin_cpus the master hands each new worker the least used core block (the lowest
+    # free one in steady state) and takes it back when the worker exits, so a worker replacing
+    # a crashed or timed-out one gets exactly the cores that were freed. During a HUP reload old
+    # and new workers briefly overlap and share blocks until the old ones exit.
+    slot_holders = [0] * args.workers
+
+    def pre_fork(server, worker):
+        worker.cpu_slot = min(range(args.workers), key=lambda slot: slot_holders[slot])
+        slot_holders[worker.cpu_slot] += 1
+
+    def child_exit(server, worker):
+        slot = getattr(worker, 'cpu_slot', None)
+        if slot is not None:
+            slot_holders[slot] -= 1
+
+    def post_fork(server, worker):
+        if args.pin_cpus and hasattr(os, 'sched_setaffinity'):
+            first = (worker.cpu_slot * args.tf_threads) % cpu_count
+            os.sched_setaffinity(0, {(first + i) % cpu_count for i in range(args.tf_threads)})
+        configure_tensorflow_threads(args.tf_threads)
+
+    class RecommendationServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', args.bind)
+            self.cfg.set('workers', args.workers)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('preload_app', False)
+            self.cfg.set('pre_fork', pre_fork)
+            self.cfg.set('post_fork', post_fork)
+            self.cfg.set('child_exit', child_exit)
+
+        def load(self):
+            from app import app
+            return app
+
+    logger.info(f"Starting {args.workers} workers x {args.tf_threads} TensorFlow threads on {args.bind}")
+    RecommendationServer().run()
+
+
+if __name__ == '__main__':
+    main()
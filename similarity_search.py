@@ -0,0 +1,117 @@
+import logging
+import os
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SEARCH_BACKENDS = ('exact', 'ivf')
+
+
+# L2-normalize every row so that a dot product equals cosine similarity.
+# Zero rows are left as zeros instead of producing NaNs.
+def normalize_rows(features, dtype=np.float32):
+    features = np.asarray(features, dtype=dtype)
+    if features.ndim == 1:
+        features = features[np.newaxis, :]
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return features / norms
+
+
+# Pick the indices of the top_k largest scores in each row, best first.
+# np.argpartition does the selection in O(N) and only the k winners are sorted.
+def top_k_indices(scores, top_k):
+    scores = np.atleast_2d(scores)
+    top_k = min(top_k, scores.shape[1])
+    if top_k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if top_k < scores.shape[1]:
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+# Exact cosine-similarity search over the catalog embeddings.
+# The catalog is normalized once when the index is built, so every query is a
+# single matrix-vector product followed by a partial top-k selection.
+# Already-normalized matrices (e.g. a memory-mapped index bundle) are used as-is;
+# float16 matrices are scored block by block so they are never upcast whole.
+class ExactSearchIndex:
+    block_size = 65536
+
+    def __init__(self, features, normalized=False):
+        self.embeddings = features if normalized else normalize_rows(features)
+
+    def __len__(self):
+        return self.embeddings.shape[0]
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    def score(self, queries):
+        if self.embeddings.dtype == np.float32:
+            return queries @ self.embeddings.T
+        scores = np.empty((queries.shape[0], len(self)), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            block = np.asarray(self.embeddings[start:start + self.block_size], dtype=np.float32)
+            scores[:, start:start + block.shape[0]] = queries @ block.T
+        return scores
+
+    # Returns (indices, scores) arrays of shape (num_queries, top_k)
+    def search_batch(self, queries, top_k=5):
+        queries = normalize_rows(queries)
+        scores = self.score(queries)
+        indices = top_k_indices(scores, top_k)
+        return indices, np.take_along_axis(scores, indices, axis=1)
+
+    # Returns (indices, scores) for a single query vector
+    def search(self, query, top_k=5):
+        indices, scores = self.search_batch(query, top_k)
+        return indices[0], scores[0]
+
+
+# Build the search backend for an index bundle. 'exact' scans every vector; 'ivf' loads the
+# approximate index trained by ann_index.py from the bundle directory (falling back to exact
+# search if it is missing or was trained on a different bundle version).
+def create_search_index(bundle, backend='exact', nprobe=None, rerank=None):
+    if backend not in SEARCH_BACKENDS:
+        raise ValueError(f"Unknown search backend: {backend}. Choose one of {SEARCH_BACKENDS}")
+
+    if backend == 'ivf':
+        from ann_index import IVFIndex, IVF_INDEX_FILE
+
+        ivf_path = os.path.join(bundle.path, IVF_INDEX_FILE)
+        if not os.path.exists(ivf_path):
+            logger.warning(f"No IVF index at {ivf_path}; using exact search")
+        else:
+            index = IVFIndex.load(ivf_path)
+            if index.source_version == bundle.version:
+                if nprobe:
+                    index.nprobe = nprobe
+                if rerank is not None:
+                    index.rerank = rerank
+                return index.attach_embeddings(bundle.embeddings)
+            logger.warning(f"IVF index was trained on bundle {index.source_version}, not {bundle.version}; "
+                           "using exact search")
+
+    return ExactSearchIndex(bundle.embeddings, normalized=True)
+
+
+# Exact search restricted to the given catalog rows (e.g. the rows matching an attribute
+# filter). Only the subset is scored, so narrow filters are cheaper than a full scan, and
+# any backend exposing the normalized catalog as .embeddings can be filtered this way.
+# Indexes with their own search_rows (e.g. segmented indexes with tombstones) handle it themselves.
+def search_rows(index, query, rows, top_k=5):
+    if hasattr(index, 'search_rows'):
+        return index.search_rows(query, rows, top_k)
+    query = normalize_rows(query)[0]
+    if len(rows) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    scores = np.asarray(index.embeddings[rows], dtype=np.float32) @ query
+    best = top_k_indices(scores, top_k)[0]
+    return rows[best], scores[best]
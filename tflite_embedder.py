@@ -0,0 +1,101 @@
+import json
+import os
+
+import numpy as np
+
+# export_tflite.py records the Keras model each artifact was converted from in
+# <artifact>.tflite.json, so a deployment shipping only the .tflite file can still be matched
+# against the model an index bundle was built with
+ARTIFACT_INFO_SUFFIX = '.json'
+
+
+def write_artifact_info(model_path, info):
+    with open(model_path + ARTIFACT_INFO_SUFFIX, 'w') as f:
+        json.dump(info, f, indent=2)
+
+
+# Fingerprint of the Keras model a .tflite artifact was converted from, or None if unknown
+def read_source_fingerprint(model_path):
+    info_path = model_path + ARTIFACT_INFO_SUFFIX
+    if not os.path.exists(info_path):
+        return None
+    with open(info_path) as f:
+        return json.load(f).get('source_fingerprint')
+
+
+# Runs an exported .tflite embedding model (see export_tflite.py) with the same predict(x)
+# interface the server uses on the Keras model. Uses the standalone tflite_runtime package when
+# installed, so serving does not need to import TensorFlow at all; otherwise falls back to
+# tf.lite. Not thread-safe: the server only calls it from the micro-batcher thread.
+#
+# Resizing an interpreter's input re-allocates all its tensors, which would happen on most
+# requests since micro-batch sizes vary. Instead there is one interpreter per power-of-two
+# batch size (capped at max_batch_size), each allocated once; a batch is zero-padded up to the
+# next size and the padding rows dropped from the output. The interpreters share the
+# memory-mapped model file, so each extra size only costs its activation buffers. With
+# max_batch_size given, all sizes are allocated up front and larger batches run in chunks.
+class TFLiteEmbedder:
+    def __init__(self, model_path, num_threads=None, max_batch_size=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.max_batch_size = max_batch_size
+        self._interpreter_class = Interpreter
+        self._interpreters = {}
+
+        interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self._input = interpreter.get_input_details()[0]
+        self._output = interpreter.get_output_details()[0]
+        if max_batch_size:
+            for batch_size in sorted({self._padded_size(n) for n in range(1, max_batch_size + 1)}):
+                self._interpreter(batch_size)
+
+    @property
+    def input_shape(self):
+        return tuple(int(d) for d in self._input['shape'][1:])
+
+    def _padded_size(self, n):
+        size = 1
+        while size < n:
+            size *= 2
+        return min(size, self.max_batch_size) if self.max_batch_size else size
+
+    def _interpreter(self, batch_size):
+        interpreter = self._interpreters.get(batch_size)
+        if interpreter is None:
+            interpreter = self._interpreter_class(model_path=self.model_path, num_threads=self.num_threads)
+            interpreter.resize_tensor_input(self._input['index'], [batch_size, *self.input_shape])
+            interpreter.allocate_tensors()
+            self._interpreters[batch_size] = interpreter
+        return interpreter
+
+    def _invoke(self, x):
+        num_rows = len(x)
+        batch_size = self._padded_size(num_rows)
+        if num_rows < batch_size:
+            x = np.concatenate([x, np.zeros((batch_size - num_rows, *x.shape[1:]), dtype=x.dtype)])
+        interpreter = self._interpreter(batch_size)
+        interpreter.set_tensor(self._input['index'], x)
+        interpreter.invoke()
+        return interpreter.get_tensor(self._output['index'])[:num_rows]
+
+    # x is a preprocessed float batch of shape (N, H, W, 3)
+    def predict(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self._input['dtype'] != np.float32:
+            scale, zero_point = self._input['quantization']
+            x = np.round(x / scale + zero_point).astype(self._input['dtype'])
+
+        chunk_size = self.max_batch_size or max(len(x), 1)
+        output = np.concatenate([self._invoke(x[start:start + chunk_size])
+                                 for start in range(0, max(len(x), 1), chunk_size)])
+
+        if self._output['dtype'] != np.float32:
+            scale, zero_point = self._output['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return np.array(output, dtype=np.float32)
@@ -0,0 +1,168 @@
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZES = (80, 160, 320)
+JPEG_QUALITY = 85
+ETAG_CACHE_ENTRIES = 4096
+
+# Thumbnails live in <cache_dir>/<size>/<filename>, regenerated whenever the source image is
+# newer than the cached file. Every file is written under a temporary name and renamed into
+# place, so concurrent workers generating the same thumbnail never serve a partial file.
+# Each served file has a sidecar <file>.etag holding its size, mtime and content hash, written
+# when the thumbnail is generated (and for originals by the CLI below), so requests read the
+# small sidecar instead of hashing the image.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pre-generate catalog thumbnails for /image/<path>?size=N')
+    parser.add_argument("--image_dir", type=str, default="images")
+    parser.add_argument("--cache_dir", type=str, default="thumbnails")
+    parser.add_argument("--sizes", type=str, default=",".join(str(s) for s in THUMBNAIL_SIZES))
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    return parser.parse_args()
+
+
+def thumbnail_path(cache_dir, filename, size):
+    return os.path.join(cache_dir, str(size), filename)
+
+
+# Sidecar of a thumbnail, or of the original image when size is None
+def etag_sidecar_path(cache_dir, filename, size=None):
+    if size is None:
+        return os.path.join(cache_dir, 'original', filename + '.etag')
+    return thumbnail_path(cache_dir, filename, size) + '.etag'
+
+
+def _write_atomically(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def write_etag_sidecar(path, sidecar_path, etag):
+    stat = os.stat(path)
+    _write_atomically(sidecar_path, f'{stat.st_size} {stat.st_mtime_ns} {etag}'.encode('ascii'))
+
+
+def _is_fresh(path, source_path):
+    try:
+        return os.stat(path).st_mtime_ns >= os.stat(source_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+# Downscale so the longer side is at most `size` pixels (never upscale) and re-encode as JPEG
+def make_thumbnail(source_path, destination_path, size, quality=JPEG_QUALITY):
+    import cv2
+
+    img = cv2.imread(source_path)
+    if img is None:
+        return False
+    height, width = img.shape[:2]
+    scale = size / max(height, width)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                         interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        return False
+
+    data = encoded.tobytes()
+    _write_atomically(destination_path, data)
+    write_etag_sidecar(destination_path, destination_path + '.etag', hashlib.sha1(data).hexdigest())
+    return True
+
+
+# Path of an up-to-date thumbnail, generating it on first use. None if the source is unreadable.
+def ensure_thumbnail(image_dir, cache_dir, filename, size):
+    source_path = os.path.join(image_dir, filename)
+    path = thumbnail_path(cache_dir, filename, size)
+    if _is_fresh(path, source_path):
+        return path
+    return path if make_thumbnail(source_path, path, size) else None
+
+
+# Strong ETags are content hashes. They are looked up in a bounded per-process LRU keyed by
+# path and (size, mtime), then in the file's sidecar; a file is hashed only when both are
+# missing or stale, and the hash is saved to the sidecar for every other worker.
+_etags = OrderedDict()
+_etags_lock = threading.Lock()
+
+
+def _read_etag_sidecar(sidecar_path, key):
+    try:
+        with open(sidecar_path) as f:
+            size, mtime_ns, etag = f.read().split()
+    except (OSError, ValueError):
+        return None
+    return etag if (int(mtime_ns), int(size)) == key else None
+
+
+def file_etag(path, sidecar_path):
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _etags_lock:
+        cached = _etags.get(path)
+        if cached and cached[0] == key:
+            _etags.move_to_end(path)
+            return cached[1]
+
+    etag = _read_etag_sidecar(sidecar_path, key)
+    if etag is None:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        etag = digest.hexdigest()
+        write_etag_sidecar(path, sidecar_path, etag)
+
+    with _etags_lock:
+        _etags[path] = (key, etag)
+        _etags.move_to_end(path)
+        while len(_etags) > ETAG_CACHE_ENTRIES:
+            _etags.popitem(last=False)
+    return etag
+
+
+def _generate_all_sizes(filename, image_dir, cache_dir, sizes):
+    results = [ensure_thumbnail(image_dir, cache_dir, filename, size) is not None for size in sizes]
+    # Hash the original once here, so serving it never has to
+    file_etag(os.path.join(image_dir, filename), etag_sidecar_path(cache_dir, filename))
+    return results
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+
+    filenames = sorted(f for f in os.listdir(args.image_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    generate = partial(_generate_all_sizes, image_dir=args.image_dir, cache_dir=args.cache_dir, sizes=sizes)
+    started_at = time.time()
+    failed = 0
+    with multiprocessing.get_context('spawn').Pool(args.workers) as pool:
+        for i, results in enumerate(pool.imap_unordered(generate, filenames, chunksize=64), 1):
+            failed += not all(results)
+            if i % 500 == 0 or i == len(filenames):
+                sys.stdout.write(f"\rThumbnails: {i}/{len(filenames)} images "
+                                 f"({i / (time.time() - started_at):.1f} images/s)")
+                sys.stdout.flush()
+    print()
+    logger.info(f"Generated sizes {sizes} for {len(filenames) - failed} images in {args.cache_dir}; "
+                f"{failed} images could not be read")
+
+
+if __name__ == '__main__':
+    main()
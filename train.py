@@ -2,6 +2,11 @@ import tensorflow as tf
 import os
 import argparse
 import json
+import time
+
+import numpy as np
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
 
 def custom_fashion_recommendation_model(input_shape, num_classes):
     model = tf.keras.Sequential([
@@ -36,6 +41,114 @@ def custom_fashion_recommendation_model(input_shape, num_classes):
 
     return model
 
+# Parse one record written by make_tfrecords.py: raw pre-resized RGB bytes and a class index
+def make_record_parser(input_shape, num_classes, record_size):
+    feature_spec = {
+        'image': tf.io.FixedLenFeature([], tf.string),
+        'label': tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse(serialized):
+        example = tf.io.parse_single_example(serialized, feature_spec)
+        image = tf.reshape(tf.io.decode_raw(example['image'], tf.uint8), [record_size[0], record_size[1], 3])
+        image = tf.cast(image, tf.float32) / 255.0
+        if input_shape[2] == 1:
+            image = tf.image.rgb_to_grayscale(image)
+        # Records are normally written at the training size; resize only when they are not
+        if list(record_size) != list(input_shape[:2]):
+            image = tf.image.resize(image, (input_shape[0], input_shape[1]))
+        return image, tf.one_hot(example['label'], num_classes)
+
+    return parse
+
+# tf.data pipeline over a directory of TFRecord shards: shards are read in parallel and
+# interleaved, records are parsed with a parallel map, optionally cached after the first epoch,
+# then shuffled, batched and prefetched so input preparation overlaps with training steps
+def record_dataset(record_dir, input_shape, batch_size, training, cache=None, shuffle_buffer=10000):
+    # make_tfrecords.py writes the class list and record image size into every split directory
+    with open(os.path.join(record_dir, 'classes.json')) as f:
+        record_info = json.load(f)
+    num_classes = len(record_info['classes'])
+
+    files = tf.data.Dataset.list_files(os.path.join(record_dir, '*.tfrecord'), shuffle=training)
+    dataset = files.interleave(tf.data.TFRecordDataset, cycle_length=AUTOTUNE, num_parallel_calls=AUTOTUNE,
+                               deterministic=not training)
+    dataset = dataset.map(make_record_parser(input_shape, num_classes, record_info['image_size']),
+                          num_parallel_calls=AUTOTUNE)
+    if cache is not None:
+        # An empty string caches in memory, anything else is a cache file prefix
+        dataset = dataset.cache(cache)
+    if training:
+        dataset = dataset.shuffle(shuffle_buffer)
+    return dataset.batch(batch_size).prefetch(AUTOTUNE), num_classes
+
+# tf.data pipeline over a packed image store (image_store.py packed with --label_column). Each
+# batch is gathered from the memory-mapped array in row order, so reads stay mostly sequential;
+# no image is decoded during training.
+def image_store_dataset(store, input_shape, class_index, batch_size, training):
+    rows = np.array([i for i, label in enumerate(store.labels) if label in class_index], dtype=np.int64)
+    labels = np.array([class_index[store.labels[i]] for i in rows], dtype=np.int64)
+    num_classes = len(class_index)
+
+    def load_batch(positions):
+        positions = np.sort(positions)
+        # The store keeps cv2's BGR order; the model is trained on RGB like flow_from_directory
+        return store.images[rows[positions]][..., ::-1], labels[positions]
+
+    def load_batch_tensors(positions):
+        images, batch_labels = tf.numpy_function(load_batch, [positions], (tf.uint8, tf.int64))
+        # numpy_function outputs have unknown rank; resize and grayscale need the shape
+        images.set_shape([None, store.target_size[1], store.target_size[0], 3])
+        batch_labels.set_shape([None])
+        return images, batch_labels
+
+    def to_model_input(images, batch_labels):
+        images = tf.cast(images, tf.float32) / 255.0
+        if input_shape[2] == 1:
+            images = tf.image.rgb_to_grayscale(images)
+        if list(store.target_size[::-1]) != list(input_shape[:2]):
+            images = tf.image.resize(images, (input_shape[0], input_shape[1]))
+        return images, tf.one_hot(batch_labels, num_classes)
+
+    dataset = tf.data.Dataset.range(len(rows))
+    if training:
+        dataset = dataset.shuffle(len(rows))
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(load_batch_tensors, num_parallel_calls=AUTOTUNE)
+    return dataset.map(to_model_input, num_parallel_calls=AUTOTUNE).prefetch(AUTOTUNE)
+
+# Logs training throughput at the end of each epoch
+class ExamplesPerSecond(tf.keras.callbacks.Callback):
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.examples = 0
+        self.started_at = time.time()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.examples += self.batch_size
+
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.time() - self.started_at
+        print(f"Epoch {epoch + 1}: {self.examples / elapsed:.1f} examples/s (training)")
+
+# Iterate the input pipeline on its own, without the model, to show how fast it can feed training
+def benchmark_input(dataset, batch_size, num_batches):
+    iterator = iter(dataset)
+    next(iterator)
+    started_at = time.time()
+    batches = 0
+    for _ in range(num_batches):
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        batches += 1
+    elapsed = time.time() - started_at
+    print(f"Input pipeline: {batches * batch_size / max(elapsed, 1e-9):.1f} examples/s over {batches} batches")
+
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", type=int, default=128)
@@ -46,6 +159,14 @@ def parse_args():
     parser.add_argument("--model_dir", type=str, default="/opt/ml/model")
     parser.add_argument("--num_classes", type=int, default=10)
     parser.add_argument("--input_shape", type=str, default="[28, 28, 1]")  # Provide the default input shape as a string
+    parser.add_argument("--data_format", type=str, default="directory", choices=["directory", "tfrecord", "image_store"],
+                        help="'tfrecord' reads shards written by make_tfrecords.py, 'image_store' stores packed "
+                             "by image_store.py with --label_column, from --train/--validation")
+    parser.add_argument("--cache", type=str, default=None,
+                        help="Cache parsed tfrecord examples; '' caches in memory, otherwise a file prefix")
+    parser.add_argument("--shuffle_buffer", type=int, default=10000)
+    parser.add_argument("--benchmark_batches", type=int, default=0,
+                        help="Time this many batches of the input pipeline alone before training")
     return parser.parse_args()
 
 def main():
@@ -54,22 +175,43 @@ def main():
     # Convert the input shape argument from a string to a list of integers
     input_shape = json.loads(args.input_shape)
 
-    # Load data using ImageDataGenerator
-    train_data_gen = tf.keras.preprocessing.image.ImageDataGenerator(rescale=1.0/255)
-    train_generator = train_data_gen.flow_from_directory(args.train, target_size=(input_shape[0], input_shape[1]), batch_size=args.batch_size, class_mode='categorical')
-
-    val_data_gen = tf.keras.preprocessing.image.ImageDataGenerator(rescale=1.0/255)
-    val_generator = val_data_gen.flow_from_directory(args.validation, target_size=(input_shape[0], input_shape[1]), batch_size=args.batch_size, class_mode='categorical')
-
-    # Get number of classes from the data generator
-    num_classes = train_generator.num_classes
+    if args.data_format == 'tfrecord':
+        train_generator, num_classes = record_dataset(args.train, input_shape, args.batch_size, training=True,
+                                                      cache=args.cache, shuffle_buffer=args.shuffle_buffer)
+        val_generator, _ = record_dataset(args.validation, input_shape, args.batch_size, training=False,
+                                          cache=args.cache and f'{args.cache}_val')
+    elif args.data_format == 'image_store':
+        from image_store import load_image_store
+        train_store = load_image_store(args.train)
+        val_store = load_image_store(args.validation)
+        if train_store.labels is None or val_store.labels is None:
+            raise ValueError("Training image stores must be packed with --label_column")
+        # Class indices in sorted order like flow_from_directory; validation rows of unseen classes are dropped
+        class_index = {name: i for i, name in enumerate(sorted(set(train_store.labels)))}
+        num_classes = len(class_index)
+        train_generator = image_store_dataset(train_store, input_shape, class_index, args.batch_size, training=True)
+        val_generator = image_store_dataset(val_store, input_shape, class_index, args.batch_size, training=False)
+    else:
+        # Load data using ImageDataGenerator
+        train_data_gen = tf.keras.preprocessing.image.ImageDataGenerator(rescale=1.0/255)
+        train_generator = train_data_gen.flow_from_directory(args.train, target_size=(input_shape[0], input_shape[1]), batch_size=args.batch_size, class_mode='categorical')
+
+        val_data_gen = tf.keras.preprocessing.image.ImageDataGenerator(rescale=1.0/255)
+        val_generator = val_data_gen.flow_from_directory(args.validation, target_size=(input_shape[0], input_shape[1]), batch_size=args.batch_size, class_mode='categorical')
+
+        # Get number of classes from the data generator
+        num_classes = train_generator.num_classes
+
+    if args.benchmark_batches:
+        benchmark_input(train_generator, args.batch_size, args.benchmark_batches)
 
     # Create the model
     model = custom_fashion_recommendation_model(input_shape, num_classes)
     model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=args.learning_rate), loss='categorical_crossentropy', metrics=['accuracy'])
 
     # Train the model
-    model.fit(train_generator, epochs=args.epochs, validation_data=val_generator)
+    model.fit(train_generator, epochs=args.epochs, validation_data=val_generator,
+              callbacks=[ExamplesPerSecond(args.batch_size)])
 
     # Save the trained model
     model.save(os.path.join(args.model_dir, 'fashion_recommendation_model'))